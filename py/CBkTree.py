@@ -0,0 +1,78 @@
+##############################################################################
+# BK-tree over 64 bit perceptual hashes with the Hamming distance as metric.
+#
+# Every node holds one hash value with its payloads (e.g. image paths) and
+# its children keyed by their distance to the node. A threshold query only
+# descends into children whose edge distance lies within
+# [d - max_distance, d + max_distance] (triangle inequality), so for small
+# thresholds only a fraction of the tree is visited.
+##############################################################################
+
+from typing import Iterable, List, Tuple
+
+
+def hamming_distance(a: int, b: int) -> int:
+    '''number of differing bits of two integer hashes'''
+    return (a ^ b).bit_count()
+
+
+class CBkTree:
+    # node layout: [hash, payloads, {distance: child}]
+    _HASH = 0
+    _PAYLOADS = 1
+    _CHILDREN = 2
+
+    def __init__(self, items: Iterable[Tuple[int, object]] = ()):
+        self.root = None
+        self.size = 0
+        for value, payload in items:
+            self.add(value, payload)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, value: int, payload) -> None:
+        """Add a payload under a hash value (equal hashes share a node)."""
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [payload], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[self._HASH])
+            if distance == 0:
+                node[self._PAYLOADS].append(payload)
+                return
+            child = node[self._CHILDREN].get(distance)
+            if child is None:
+                node[self._CHILDREN][distance] = [value, [payload], {}]
+                return
+            node = child
+
+    def query(self, value: int, max_distance: int) -> List[Tuple[int, int, list]]:
+        """Return (distance, hash, payloads) of all nodes within max_distance."""
+        result = []
+        if self.root is None:
+            return result
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value, node[self._HASH])
+            if distance <= max_distance:
+                result.append((distance, node[self._HASH], node[self._PAYLOADS]))
+            low = distance - max_distance
+            high = distance + max_distance
+            for edge, child in node[self._CHILDREN].items():
+                if low <= edge <= high:
+                    stack.append(child)
+        return result
+
+    def nodes(self):
+        """Yield (hash, payloads) of every node."""
+        if self.root is None:
+            return
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            yield node[self._HASH], node[self._PAYLOADS]
+            stack.extend(node[self._CHILDREN].values())
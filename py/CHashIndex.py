@@ -0,0 +1,175 @@
+##############################################################################
+# Compact binary hash index, exported from a CPigDb next to the database.
+#
+# Layout (header little endian, records big endian):
+#   header   magic, version, content hash algorithm (see content_hash.py),
+#            md5 count, phash count, section offsets
+#   paths    per path: u32 length + utf-8 bytes
+#   md5      sorted records: 16 byte digest + u64 offset into paths
+#   phash    sorted records: u64 pHash + u64 offset into paths
+# The file is memory-mapped and searched with binary search over the fixed
+# width records, so opening it costs nothing and a lookup touches only the
+# ~log2(n) pages on its search path. Equal hashes are adjacent records.
+##############################################################################
+
+import bisect
+import mmap
+import os
+import struct
+from typing import Dict, Iterable, List, Tuple
+
+from content_hash import DEFAULT_ALGORITHM
+
+
+class _Keys:
+    """Sequence view of the keys of one record section (for bisect)."""
+
+    def __init__(self, data, offset: int, count: int, record: struct.Struct, key_size: int):
+        self.data = data
+        self.offset = offset
+        self.count = count
+        self.size = record.size
+        self.key_size = key_size
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: int) -> bytes:
+        start = self.offset + i * self.size
+        return self.data[start:start + self.key_size]
+
+
+class CHashIndex:
+    MAGIC = b"PIGIDX\0\0"
+    # 2 - algorithm of the md5 records in the header
+    VERSION = 2
+    EXTENSION = ".idx"
+
+    _HEADER = struct.Struct("<8sII16sQQQQQ")
+    _PATH_LENGTH = struct.Struct("<I")
+    # records are big endian, so the byte order of a pHash key is its numeric order
+    _MD5_RECORD = struct.Struct(">16sQ")
+    _PHASH_RECORD = struct.Struct(">QQ")
+    _OFFSET = struct.Struct(">Q")
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self._file = open(file_name, "rb")
+        self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, algorithm, md5_count, phash_count, paths_offset, md5_offset, \
+            phash_offset = self._HEADER.unpack_from(self.data, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            self.close()
+            raise ValueError(f"{file_name} is no hash index (version {self.VERSION}), "
+                             f"export it again with gen_hashes.py --export-index")
+        # content hash the md5 records were made with
+        self.algorithm = algorithm.rstrip(b"\0").decode("ascii")
+        self.paths_offset = paths_offset
+        self.md5_keys = _Keys(self.data, md5_offset, md5_count, self._MD5_RECORD, 16)
+        self.phash_keys = _Keys(self.data, phash_offset, phash_count, self._PHASH_RECORD, 8)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        self.data.close()
+        self._file.close()
+
+    @staticmethod
+    def default_file_name(db_file: str) -> str:
+        return os.path.splitext(db_file)[0] + CHashIndex.EXTENSION
+
+    @classmethod
+    def write(cls, file_name: str, paths: Iterable[Tuple[int, str]],
+              md5_rows: Iterable[Tuple[bytes, int]], phash_rows: Iterable[Tuple[int, int]],
+              algorithm: str = DEFAULT_ALGORITHM) -> Tuple[int, int]:
+        """Write an index from (id, path), md5-sorted (digest, id) and
+        numerically sorted (unsigned phash, id) rows; returns (md5 count, phash count).
+        algorithm is the content hash of the md5 rows, stored in the header.
+
+        The file is written next to the target and renamed at the end, so
+        readers never see a half-written index.
+        """
+        tmp_name = file_name + ".tmp"
+        with open(tmp_name, "wb") as f:
+            f.write(bytes(cls._HEADER.size))
+            paths_offset = f.tell()
+            offsets = {}
+            position = 0
+            for row_id, path in paths:
+                encoded = path.encode("utf-8", "surrogateescape")
+                f.write(cls._PATH_LENGTH.pack(len(encoded)))
+                f.write(encoded)
+                offsets[row_id] = position
+                position += cls._PATH_LENGTH.size + len(encoded)
+
+            md5_offset = f.tell()
+            md5_count = 0
+            for digest, row_id in md5_rows:
+                f.write(cls._MD5_RECORD.pack(digest, offsets[row_id]))
+                md5_count += 1
+
+            phash_offset = f.tell()
+            phash_count = 0
+            for value, row_id in phash_rows:
+                f.write(cls._PHASH_RECORD.pack(value, offsets[row_id]))
+                phash_count += 1
+
+            f.seek(0)
+            f.write(cls._HEADER.pack(cls.MAGIC, cls.VERSION, 0, algorithm.encode("ascii"),
+                                     md5_count, phash_count, paths_offset, md5_offset, phash_offset))
+        os.replace(tmp_name, file_name)
+        return md5_count, phash_count
+
+    def _path(self, offset: int) -> str:
+        start = self.paths_offset + offset
+        (length,) = self._PATH_LENGTH.unpack_from(self.data, start)
+        start += self._PATH_LENGTH.size
+        return self.data[start:start + length].decode("utf-8", "surrogateescape")
+
+    def _lookup(self, keys: _Keys, key: bytes) -> List[str]:
+        paths = []
+        i = bisect.bisect_left(keys, key)
+        while i < len(keys) and keys[i] == key:
+            start = keys.offset + i * keys.size + keys.key_size
+            paths.append(self._path(self._OFFSET.unpack_from(self.data, start)[0]))
+            i += 1
+        return paths
+
+    def lookup_md5(self, md5_hash) -> List[str]:
+        """Paths with this md5 (hex text or 16 bytes), [] if it is not in the archive."""
+        if not isinstance(md5_hash, (bytes, bytearray)):
+            md5_hash = bytes.fromhex(md5_hash)
+        return self._lookup(self.md5_keys, bytes(md5_hash))
+
+    def lookup_phash(self, image_hash) -> List[str]:
+        """Paths with exactly this pHash (hex text or int)."""
+        if not isinstance(image_hash, int):
+            image_hash = int(str(image_hash), 16)
+        return self._lookup(self.phash_keys, self._PHASH_RECORD.pack(image_hash, 0)[:8])
+
+    def contains_md5(self, md5_hash) -> bool:
+        if not isinstance(md5_hash, (bytes, bytearray)):
+            md5_hash = bytes.fromhex(md5_hash)
+        md5_hash = bytes(md5_hash)
+        i = bisect.bisect_left(self.md5_keys, md5_hash)
+        return i < len(self.md5_keys) and self.md5_keys[i] == md5_hash
+
+    def lookup_md5_many(self, md5_hashes: Iterable) -> Dict[str, List[str]]:
+        """Batch lookup: {md5: [paths]} for the candidates found in the archive."""
+        found = {}
+        for md5_hash in md5_hashes:
+            paths = self.lookup_md5(md5_hash)
+            if paths:
+                key = md5_hash.hex() if isinstance(md5_hash, (bytes, bytearray)) else md5_hash
+                found[key] = paths
+        return found
+
+    def count_md5(self) -> int:
+        return len(self.md5_keys)
+
+    def count_phash(self) -> int:
+        return len(self.phash_keys)
@@ -0,0 +1,93 @@
+##############################################################################
+# Minimal Linux inotify binding over ctypes (no extra package needed).
+#
+# One instance holds one inotify file descriptor; add_watch() subscribes a
+# directory and read() returns the queued events as
+# (wd, mask, cookie, name) tuples, name being the entry inside the watched
+# directory ('' for events on the directory itself). The cookie pairs the
+# IN_MOVED_FROM and IN_MOVED_TO events of one rename.
+##############################################################################
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+from typing import List, Tuple
+
+
+class CInotify:
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_DONT_FOLLOW = 0x02000000
+    IN_ISDIR = 0x40000000
+
+    _IN_CLOEXEC = 0o2000000
+    _IN_NONBLOCK = 0o4000
+    _EVENT = struct.Struct("iIII")
+    _READ_SIZE = 256 * 1024
+
+    _libc = None
+
+    def __init__(self):
+        if CInotify._libc is None:
+            CInotify._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = self._libc.inotify_init1(self._IN_CLOEXEC | self._IN_NONBLOCK)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1: {os.strerror(errno)}")
+        self.fd = fd
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def add_watch(self, path: str, mask: int) -> int:
+        """Watch a directory, returns the watch descriptor (OSError on failure)."""
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_add_watch: {os.strerror(errno)}", path)
+        return wd
+
+    def rm_watch(self, wd: int) -> None:
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout: float = None) -> List[Tuple[int, int, int, str]]:
+        """Events queued so far, waits up to timeout seconds for the first one."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, self._READ_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self._EVENT.unpack_from(data, offset)
+            offset += self._EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+        return events
@@ -0,0 +1,239 @@
+##############################################################################
+# Disk-aware read scheduling in front of the hashing.
+#
+# order() sorts the walk entries so every disk reads them front to back:
+#   walk   - as found by the tree walk (no sorting)
+#   inode  - by device and inode number, free since the walk fingerprint
+#            has both; on ext4/xfs inodes roughly follow the data layout
+#   fiemap - by device and physical offset of the first extent (FIEMAP
+#            ioctl, one open per file); devices whose filesystem does not
+#            support it fall back to the inode order
+# iter_read() then reads the files ahead with a thread pool and adapts the
+# number of concurrent reads to the measured throughput: starting with one
+# sequential stream the depth is doubled while that pays off and set back
+# to the best depth when not, so SSDs end up with deep queues and HDDs
+# with a single stream. The probe restarts for every device, the entries
+# are grouped by device after order().
+# The data read ahead is bounded in bytes, not only in files: every read
+# reserves the file size from a budget that the consumer gives back with
+# release() once the data is hashed, so queues and hashing window together
+# never hold more than max_bytes_in_flight (one file always fits).
+##############################################################################
+
+import errno
+import fcntl
+import os
+import struct
+import threading
+import time
+from collections import deque
+
+
+class CIoScheduler:
+    ORDERS = ("walk", "inode", "fiemap")
+    DEFAULT_MAX_READERS = 32
+    # throughput is compared over windows of this many seconds
+    SAMPLE_SECONDS = 1.0
+    # a deeper queue has to be this much faster to be kept
+    MIN_GAIN = 1.1
+    # after this many samples at the chosen depth the next one is probed again
+    REPROBE_SAMPLES = 30
+    # files from this size on are not read ahead but mapped by the worker
+    MAX_READ_AHEAD_SIZE = 64 * 1024 * 1024
+    # read-ahead data held at once, from the read until release()
+    DEFAULT_MAX_BYTES_IN_FLIGHT = 512 * 1024 * 1024
+
+    # struct fiemap with room for one struct fiemap_extent (linux/fiemap.h)
+    _FS_IOC_FIEMAP = 0xC020660B
+    _FIEMAP = struct.Struct("=QQIIII")
+    _FIEMAP_EXTENT = struct.Struct("=QQQQQIIII")
+    _NOT_SUPPORTED = (errno.ENOTTY, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS)
+
+    def __init__(self, readers=None, max_readers: int = DEFAULT_MAX_READERS, profiler=None,
+                 max_bytes_in_flight: int = DEFAULT_MAX_BYTES_IN_FLIGHT):
+        # readers: fixed number of concurrent reads, None adapts it
+        self.adaptive = readers is None
+        self.max_readers = max_readers if self.adaptive else max(1, readers)
+        self.readers = 1 if self.adaptive else self.max_readers
+        self.profiler = profiler
+        self.device = None
+        self.device_readers = {}  # device -> depth chosen
+        self.total_bytes = 0
+        self.total_seconds = 0.0
+        self.max_bytes_in_flight = max_bytes_in_flight
+        self.bytes_in_flight = 0
+        self._budget = threading.Condition()
+        self._restart()
+
+    def _restart(self) -> None:
+        if self.adaptive:
+            self.readers = 1
+        self._best = 0.0
+        self._best_readers = self.readers
+        self._settled = 0
+        self._sample_start = time.perf_counter()
+        self._sample_bytes = 0
+
+    @classmethod
+    def physical_offset(cls, file_path):
+        """Physical byte offset of the first extent, None if the file has no
+        extent (empty or inline); OSError if FIEMAP is not supported."""
+        request = bytearray(cls._FIEMAP.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)
+                            + bytes(cls._FIEMAP_EXTENT.size))
+        fd = os.open(file_path, os.O_RDONLY | os.O_NOFOLLOW)
+        try:
+            fcntl.ioctl(fd, cls._FS_IOC_FIEMAP, request)
+        finally:
+            os.close(fd)
+        if cls._FIEMAP.unpack_from(request)[3] == 0:
+            return None
+        return cls._FIEMAP_EXTENT.unpack_from(request, cls._FIEMAP.size)[1]
+
+    @classmethod
+    def order(cls, entries, mode: str = "inode") -> list:
+        """(file_path, fingerprint) walk entries in read order for mode."""
+        if mode not in cls.ORDERS:
+            raise ValueError(f"Unknown I/O order {mode} (known: {', '.join(cls.ORDERS)})")
+        entries = list(entries)
+        if mode == "walk":
+            return entries
+        if mode == "inode":
+            return sorted(entries, key=lambda entry: (entry[1][3], entry[1][2]))
+
+        offsets = {}
+        unsupported = set()
+        for file_path, fingerprint in entries:
+            device = fingerprint[3]
+            if device in unsupported:
+                continue
+            try:
+                offsets[file_path] = cls.physical_offset(file_path) or 0
+            except OSError as e:
+                if e.errno in cls._NOT_SUPPORTED:
+                    unsupported.add(device)
+                    print(f"FIEMAP not supported on device {device:#x}, using inode order")
+
+        def key(entry):
+            file_path, fingerprint = entry
+            device = fingerprint[3]
+            if device in unsupported or file_path not in offsets:
+                return device, 1, fingerprint[2]
+            return device, 0, offsets[file_path]
+        return sorted(entries, key=key)
+
+    def _read(self, file_path):
+        start = time.perf_counter()
+        try:
+            with open(file_path, "rb") as f:
+                data = f.read()
+        except OSError:
+            # the worker reads it again and reports the error
+            data = None
+        return data, time.perf_counter() - start
+
+    def _adapt(self, nbytes: int) -> None:
+        self._sample_bytes += nbytes
+        now = time.perf_counter()
+        elapsed = now - self._sample_start
+        if elapsed < self.SAMPLE_SECONDS:
+            return
+        throughput = self._sample_bytes / elapsed
+        self._sample_start = now
+        self._sample_bytes = 0
+        if not self.adaptive:
+            return
+
+        if throughput > self._best * self.MIN_GAIN:
+            self._best = throughput
+            self._best_readers = self.readers
+            self._settled = 0
+            self.readers = min(self.readers * 2, self.max_readers)
+        elif self.readers != self._best_readers:
+            self.readers = self._best_readers
+        else:
+            # the best depth may change (other files, other load):
+            # remeasure it now and then and probe one step deeper
+            self._settled += 1
+            if self._settled >= self.REPROBE_SAMPLES:
+                self._best = throughput
+                self._settled = 0
+                self.readers = min(self.readers * 2, self.max_readers)
+        self.device_readers[self.device] = self._best_readers
+
+    def _reserve(self, nbytes: int, wait: bool) -> bool:
+        """Takes nbytes from the read-ahead budget, False if it is used up and not wait."""
+        with self._budget:
+            while self.bytes_in_flight and self.bytes_in_flight + nbytes > self.max_bytes_in_flight:
+                if not wait:
+                    return False
+                self._budget.wait()
+            self.bytes_in_flight += nbytes
+            return True
+
+    def _free(self, nbytes: int) -> None:
+        with self._budget:
+            self.bytes_in_flight -= nbytes
+            self._budget.notify_all()
+
+    def release(self, entry) -> None:
+        """Gives the budget of an iter_read() entry back once its data is no
+        longer needed; safe from any thread and for entries without data."""
+        if len(entry) > 2 and entry[2] is not None:
+            self._free(entry[1][0])
+
+    def iter_read(self, entries):
+        """Yields (file_path, fingerprint, data) in input order, data read
+        ahead by the thread pool (None for large or unreadable files, the
+        worker reads them itself). Reading ahead stops while the byte budget
+        is used up, every entry has to be given back with release()."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        pending = deque()
+        entries = iter(entries)
+        exhausted = False
+        held = None  # next entry, waiting for budget
+        with ThreadPoolExecutor(max_workers=self.max_readers,
+                                thread_name_prefix="reader") as pool:
+            while True:
+                while not exhausted and len(pending) < self.readers:
+                    entry = held or next(entries, None)
+                    held = None
+                    if entry is None:
+                        exhausted = True
+                        break
+                    file_path, fingerprint = entry
+                    if fingerprint[3] != self.device:
+                        self.device = fingerprint[3]
+                        self._restart()
+                    if fingerprint[0] >= self.MAX_READ_AHEAD_SIZE:
+                        pending.append((entry, None))
+                    elif self._reserve(fingerprint[0], wait=not pending):
+                        pending.append((entry, pool.submit(self._read, file_path)))
+                    else:
+                        # hand out what was read before waiting for budget
+                        held = entry
+                        break
+                if not pending:
+                    break
+
+                (file_path, fingerprint), future = pending.popleft()
+                data = None
+                if future is not None:
+                    data, seconds = future.result()
+                    if data is None:
+                        self._free(fingerprint[0])
+                    else:
+                        self.total_bytes += len(data)
+                        self.total_seconds += seconds
+                        if self.profiler is not None:
+                            self.profiler.add("read_ahead", seconds, len(data), 1)
+                        self._adapt(len(data))
+                yield file_path, fingerprint, data
+
+    def summary(self) -> str:
+        """One line about the depth chosen per device and the bytes read."""
+        depths = ", ".join(f"{device:#x}: {readers}"
+                           for device, readers in sorted(self.device_readers.items()))
+        mode = f"readers per device {depths or self.readers}" if self.adaptive \
+            else f"{self.readers} readers"
+        return f"Read ahead {self.total_bytes / 1e6:.1f} MB, {mode}"
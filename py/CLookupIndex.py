@@ -0,0 +1,135 @@
+##############################################################################
+# In-memory md5 and pHash index of a CPigDb for the lookup daemon.
+#
+# md5 lookups are dict hits, pHash lookups BK-tree queries (CBkTree). The
+# index follows the database while gen_hashes is writing: refresh() checks
+# PRAGMA data_version and only reads the rows appended since the last
+# refresh (id > last id). If the change counter of the database moved
+# (rows updated, rehashed, renamed, deleted or marked missing), the whole
+# index is rebuilt and swapped in at once.
+##############################################################################
+
+import threading
+from typing import Dict, Iterable, List
+
+from CBkTree import CBkTree
+from CPigDb import CPigDb
+
+
+class CLookupIndex:
+
+    def __init__(self, db_file: str):
+        # the database connection belongs to the thread calling
+        # load()/refresh(), queries may come from any thread
+        self.db_file = db_file
+        self.db = None
+        self.lock = threading.Lock()
+        self.md5 = {}
+        self.tree = CBkTree()
+        self.last_id = 0
+        self.counts = {"total_images": 0, "images_with_md5": 0, "images_with_image_hash": 0}
+        self.data_version = None
+        self.changes = None
+        self.reloads = 0
+        # message of the last failed load/refresh, None after a good one
+        self.last_error = None
+        # {algorithm: count} of the content hashes in the database
+        self.hash_algorithms = {}
+
+    def open(self) -> bool:
+        self.db = CPigDb(self.db_file)
+        if self.db.get_error() != self.db.ERROR_STAT_NONE:
+            print(f"Error opening database: {self.db.get_error()}")
+            return False
+        return True
+
+    def close(self) -> None:
+        if self.db is not None:
+            self.db.close()
+
+    def _add_rows(self, rows, md5, tree, counts) -> int:
+        last_id = 0
+        for row_id, md5_hash, image_hash, path in rows:
+            counts["total_images"] += 1
+            if md5_hash is not None:
+                md5.setdefault(bytes(md5_hash), []).append(path)
+                counts["images_with_md5"] += 1
+            if image_hash is not None:
+                tree.add(image_hash & CPigDb.PHASH_MASK, path)
+                counts["images_with_image_hash"] += 1
+            last_id = row_id
+        return last_id
+
+    def load(self) -> None:
+        """Builds the whole index from the database and swaps it in."""
+        data_version = self.db.get_data_version()
+        changes = self.db.get_change_count()
+        md5, tree = {}, CBkTree()
+        counts = dict.fromkeys(self.counts, 0)
+        last_id = self._add_rows(self.db.iter_hashes_since(0), md5, tree, counts)
+        hash_algorithms = self.db.get_hash_algorithms()
+        with self.lock:
+            self.md5, self.tree, self.counts = md5, tree, counts
+            self.hash_algorithms = hash_algorithms
+            self.last_id = last_id
+            self.data_version = data_version
+            self.changes = changes
+            self.reloads += 1
+
+    def refresh(self) -> bool:
+        """Adds new rows, rebuilds the index if other changes are detected.
+
+        Returns True if the database had changed.
+        """
+        data_version = self.db.get_data_version()
+        if data_version == self.data_version:
+            return False
+        if self.db.get_change_count() != self.changes:
+            # rows changed in place, appending is not enough
+            self.load()
+            return True
+        # the appended rows go straight into the live index, under the lock
+        # only for the time of the additions
+        rows = list(self.db.iter_hashes_since(self.last_id))
+        hash_algorithms = self.db.get_hash_algorithms()
+        with self.lock:
+            last_id = self._add_rows(rows, self.md5, self.tree, self.counts)
+            self.last_id = max(self.last_id, last_id)
+            self.data_version = data_version
+            self.hash_algorithms = hash_algorithms
+        return True
+
+    def lookup_md5(self, md5_hashes: Iterable[str]) -> Dict[str, List[str]]:
+        """{md5: [paths]} of all given md5 hashes found in the archive."""
+        found = {}
+        with self.lock:
+            for md5_hash in md5_hashes:
+                paths = self.md5.get(CPigDb.md5_to_blob(md5_hash))
+                if paths:
+                    found[md5_hash] = list(paths)
+        return found
+
+    def lookup_phash(self, image_hashes: Iterable[str], max_distance: int) -> Dict[str, list]:
+        """{phash: [(distance, phash, [paths])]} of all similar images, nearest first."""
+        found = {}
+        with self.lock:
+            for image_hash in image_hashes:
+                value = CPigDb.phash_to_int(image_hash) & CPigDb.PHASH_MASK
+                matches = sorted(self.tree.query(value, max_distance))
+                if matches:
+                    found[image_hash] = [(distance, CPigDb.int_to_phash(other), list(paths))
+                                         for distance, other, paths in matches]
+        return found
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                "db": self.db_file,
+                "md5_hashes": len(self.md5),
+                "phash_images": len(self.tree),
+                "last_id": self.last_id,
+                "reloads": self.reloads,
+                "last_error": self.last_error,
+                "hash_algorithms": dict(self.hash_algorithms),
+                **self.counts,
+            }
@@ -1,26 +1,90 @@
 import sqlite3
-from pathlib import Path
+import itertools
 import os
-from typing import List, Tuple
+import time
+import urllib.parse
+from typing import Iterator, List, Tuple
+
+from CBkTree import CBkTree
 
 class CPigDb:
     KEY_MD5 = "md5_hash"
     KEY_IMAGE = "image_hash"
     KEY_PATH = "path" 
+    KEY_SIZE = "size"
+    KEY_MTIME_NS = "mtime_ns"
+    KEY_INODE = "inode"
+    KEY_DEVICE = "device"
+    KEY_MISSING = "missing"
+    KEY_PARTIAL = "partial_hash"
+    KEY_ALGORITHM = "hash_algorithm"
+
+    # content hash of rows without algorithm (databases before version 5)
+    DEFAULT_HASH_ALGORITHM = "md5"
+
+    # file fingerprint columns (missing in schema version 1)
+    FINGERPRINT_COLUMNS = (KEY_SIZE, KEY_MTIME_NS, KEY_INODE, KEY_DEVICE)
+
+    # PRAGMA user_version of the current schema:
+    # 1 - md5 as hex TEXT, phash as TEXT, missing values as 'None'
+    # 2 - md5 as 16 byte BLOB, phash as signed 64 bit INTEGER, NULL, indexes
+    # 3 - partial_hash (md5 of head and tail) for the fast duplicate mode
+    # 4 - images_stats counters, maintained by triggers
+    # 5 - hash_algorithm of md5_hash and partial_hash per row (md5, blake2b, ...)
+    # 6 - images_stats.double_groups (md5 groups with more than one file)
+    # 7 - images_algorithm_stats, hashed entries per hash_algorithm
+    # 8 - images_changes, counter of updated and deleted rows
+    SCHEMA_VERSION = 8
+
+    # counters of images_stats that are sums over the rows (_stats_expressions)
+    ROW_STATS_COLUMNS = ("total_images", "images_with_md5", "images_with_image_hash",
+                         "images_with_both_hashes", "missing_images")
+    # all counters of images_stats (and keys of get_counters)
+    STATS_COLUMNS = ROW_STATS_COLUMNS + ("double_groups",)
     
+    # accepted as "no hash" on input (legacy text value)
     VALUE_NONE = "None"
 
     ERROR_STAT_NONE = "ERROR_NONE"
     
     ERROR_DB_FILE = "ERROR_FILE"
     ERROR_DATABASE_INTEGRITY = "ERROR_DATABASE_INTEGRITY"
+    ERROR_DATABASE_READ_ONLY = "ERROR_DATABASE_READ_ONLY"
     ERROR_UNREGISTERED_FILES = "ERROR_UNREGISTERED_FILES"
     ERROR_FILES_LOST = "ERROR_FILES_LOST"
+
+    # rows per transaction for the bulk insert/upsert methods
+    DEFAULT_BATCH_SIZE = 1000
+    # page cache of the connection in KiB
+    CACHE_SIZE_KIB = 64 * 1024
+    # size of the prepared statement cache of the connection
+    CACHED_STATEMENTS = 256
+
+    # database files validated (and migrated) in this process:
+    # absolute path -> (device, inode); a second CPigDb of the same file
+    # skips the checks as long as the file was not replaced. Deliberately
+    # not kept across processes: the check is one sqlite_master query and
+    # PRAGMA user_version on the connection every process opens anyway
+    # (well under a millisecond), a cache file would cost about as much to
+    # read and could only be trusted after reading user_version again
+    _validated = {}
     
-    def __init__(self, file_name: str):
+    def __init__(self, file_name: str, read_only: bool = False, wal: bool = False):
         self.file_name = file_name
+        self.conn = None
+        # read_only opens the file with mode=ro (also done if it is not writable),
+        # wal switches the write paths to the WAL journal (local file systems only)
+        self.read_only = read_only
+        self.wal = wal
+        # optional CProfiler, times the batch writes as stage "db_write"
+        self.profiler = None
         self.unregistered_files = []
         self.lost_files = []
+        self.changed_files = []
+        # root of the stored paths, None = directory of the database
+        self.root = None
+        # attached databases of other archives: (alias, file_name, root)
+        self.archives = []
         self.__init_error__()
         self.is_valid_db()
        
@@ -28,17 +92,83 @@ class CPigDb:
         self.d_error = {
             self.ERROR_DB_FILE: None,
             self.ERROR_DATABASE_INTEGRITY: None,
+            self.ERROR_DATABASE_READ_ONLY: None,
             self.ERROR_UNREGISTERED_FILES: None,
             self.ERROR_FILES_LOST: None
         }
 
+    @staticmethod
+    def _uri(file_name: str, read_only: bool = False) -> str:
+        """file:-URI einer Datenbankdatei, mit read_only im Modus ro."""
+        uri = "file:" + urllib.parse.quote(os.path.abspath(file_name))
+        return uri + "?mode=ro" if read_only else uri
+
+    def is_read_only(self) -> bool:
+        """True, wenn nur lesend geöffnet wird (gewünscht oder Datei/Verzeichnis nicht beschreibbar)."""
+        if self.read_only:
+            return True
+        if not os.path.exists(self.file_name):
+            return False
+        directory = os.path.dirname(os.path.abspath(self.file_name))
+        # the rollback journal is created next to the database
+        return not (os.access(self.file_name, os.W_OK) and os.access(directory, os.W_OK))
+
+    def get_connection(self) -> sqlite3.Connection:
+        """Gibt die langlebige Verbindung zurück und öffnet sie beim ersten Aufruf.
+
+        Beim Öffnen wird nichts in die Datei geschrieben; nur lesbare
+        Datenbanken werden mit mode=ro geöffnet. Das Journal stellen erst
+        die Schreibpfade um (siehe _set_journal_mode).
+        """
+        if self.conn is None:
+            conn = sqlite3.connect(self._uri(self.file_name, self.is_read_only()), uri=True,
+                                   cached_statements=self.CACHED_STATEMENTS)
+            for pragma in (f"PRAGMA cache_size=-{self.CACHE_SIZE_KIB};",
+                           "PRAGMA temp_store=MEMORY;"):
+                try:
+                    conn.execute(pragma)
+                except sqlite3.OperationalError:
+                    # only tuning, the connection works without it
+                    pass
+                except sqlite3.DatabaseError:
+                    conn.close()
+                    raise
+            self.conn = conn
+        return self.conn
+
+    def _set_journal_mode(self, conn):
+        """Setzt das Journal für Schreibpfade: WAL (mit wal) oder das Standard-Journal.
+
+        WAL mit synchronous=NORMAL vermeidet ein fsync pro Commit, bleibt
+        aber an der Datei hängen: Leser brauchen dann Schreibrechte für
+        -wal/-shm, und auf Netzlaufwerken funktioniert es nicht. Ohne wal
+        wird eine WAL-Datenbank deshalb wieder zurückgestellt.
+        """
+        mode = "WAL" if self.wal else "DELETE"
+        try:
+            current = conn.execute("PRAGMA journal_mode;").fetchone()[0].upper()
+            if current != mode and current in ("WAL", "DELETE"):
+                current = conn.execute(f"PRAGMA journal_mode={mode};").fetchone()[0].upper()
+            if current == "WAL":
+                conn.execute("PRAGMA synchronous=NORMAL;")
+            elif self.wal:
+                print(f"WAL journal not available for {self.file_name}, using {current.lower()}")
+        except sqlite3.OperationalError as e:
+            # e.g. locked by another connection, the journal stays as it is
+            print(f"Cannot set journal mode {mode} for {self.file_name}: {e}")
+
+    def close(self):
+        """Schließt die Verbindung (ein späterer Zugriff öffnet sie neu)."""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
     def create_database(self):
         """Erstellt eine neue Datenbankdatei mit der erforderlichen Tabelle."""
         try:
-            with sqlite3.connect(self.file_name) as conn:
-                self.conn = conn
-                self._create_table()
-                self.d_error[self.ERROR_DB_FILE] = None  # Fehler zurücksetzen
+            self._set_journal_mode(self.get_connection())
+            self._create_table()
+            self.d_error[self.ERROR_DB_FILE] = None  # Fehler zurücksetzen
         except sqlite3.DatabaseError:
             self.__set_error__(self.ERROR_DATABASE_INTEGRITY)
             
@@ -55,132 +185,412 @@ class CPigDb:
         return self.ERROR_STAT_NONE
 
     def is_valid_db(self) -> bool:
-        """Prüft, ob die Datei eine gültige SQLite-Datenbank mit Tabelle 'images' ist."""
-        db_file_path = Path(self.file_name)
-        
-        if not db_file_path.exists():
+        """Prüft, ob die Datei eine gültige SQLite-Datenbank mit Tabelle 'images' ist.
+
+        Das Ergebnis wird nur pro Prozess zwischengespeichert (_validated,
+        siehe dort), die Verbindung wird dann erst beim ersten Zugriff
+        geöffnet.
+        """
+        try:
+            st = os.stat(self.file_name)
+        except OSError:
             self.__set_error__(self.ERROR_DB_FILE)
             print (f"Database file {self.file_name} does not exist.")
             return False
         
-        if db_file_path.stat().st_size < 100:
+        if st.st_size < 100:
             self.__set_error__(self.ERROR_DB_FILE)
             print (f"Database file {self.file_name} is too small to be a valid database.")
             return False
+
+        key = os.path.abspath(self.file_name)
+        if self._validated.get(key) == (st.st_dev, st.st_ino):
+            return True
         
         try:
-            with sqlite3.connect(self.file_name) as conn:
-                cursor = conn.execute(
-                    "SELECT name FROM sqlite_master WHERE type='table' AND name='images';"
-                )
-                return cursor.fetchone() is not None
+            conn = self.get_connection()
+            cursor = conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name='images';"
+            )
+            if cursor.fetchone() is None:
+                return False
+            if self.is_read_only() and self._needs_migration(conn):
+                self.__set_error__(self.ERROR_DATABASE_READ_ONLY)
+                print(f"Database {self.file_name} needs a schema migration, "
+                      f"open it once with write access.")
+                return False
+            self._migrate_schema(conn)
+            self._validated[key] = (st.st_dev, st.st_ino)
+            return True
         except sqlite3.DatabaseError:
-            self.error = self.ERROR_DATABASE_INTEGRITY
+            self.__set_error__(self.ERROR_DATABASE_INTEGRITY)
             return False
 
-    def check_unregistered_files(self) -> bool:
-        db_file_path = Path(self.file_name)
-        db_file_path_str = str(db_file_path.parent)
-        # get all files in the directory
-        files_in_dir = list(Path(db_file_path_str).glob('*'))
-        # filter out the database file itself
-        other_files = [f for f in files_in_dir if f != db_file_path]
-        #filter only files (not directories)
-        other_files = [f for f in other_files if f.is_file()]
-        # check if there are any other files and check if they are in the database
-        self.unregistered_files = []
-        if other_files:
-            try:
-                with sqlite3.connect(self.file_name) as conn:
-                    cursor = conn.execute(f"SELECT {self.KEY_PATH} FROM images;")
-                    db_paths = {row[0] for row in cursor.fetchall()}
-                    for other_file in other_files:
-                        if str(other_file) not in db_paths:
-                            self.unregistered_files.append(str(other_file))
-                    if self.unregistered_files:
-                        self.__set_error__(self.ERROR_UNREGISTERED_FILES)
-                        return False
-            except sqlite3.DatabaseError:
-                self.__set_error__(self.ERROR_DATABASE_INTEGRITY)
-                return False
+    def iter_paths_sorted(self) -> Iterator[tuple]:
+        """Streamt (path, size, mtime_ns, missing) aller Einträge, sortiert nach Pfad."""
+        cursor = self.get_connection().execute(f'''
+            SELECT {self.KEY_PATH}, {self.KEY_SIZE}, {self.KEY_MTIME_NS}, {self.KEY_MISSING}
+            FROM images ORDER BY {self.KEY_PATH};
+        ''')
+        yield from cursor
 
-    def check_lost_files(self) -> bool:
-        """Prüft, ob in der Datenbank Pfade zu Dateien existieren, die nicht mehr vorhanden sind."""
+    def check_files(self, root: str = None, threads: int = None) -> bool:
+        """Gleicht die Datenbank in einem Durchlauf mit dem Verzeichnisbaum ab.
+
+        root ist das Verzeichnis, zu dem die Pfade relativ sind (Standard:
+        Verzeichnis der Datenbank). Füllt unregistered_files, lost_files und
+        changed_files.
+        """
+        from reconcile import reconcile, db_file_names, DEFAULT_THREADS, \
+            EVENT_NEW, EVENT_MISSING
+
+        if root is None:
+            root = self.get_root()
+        events = {EVENT_NEW: [], EVENT_MISSING: []}
+        self.changed_files = []
         try:
-            with sqlite3.connect(self.file_name) as conn:
-                cursor = conn.execute(f"SELECT {self.KEY_PATH} FROM images;")
-                db_paths = {row[0] for row in cursor.fetchall()}
-                self.lost_files = [path for path in db_paths if not Path(path).exists()]
-                if lost_files:
-                    self.error = self.ERROR_UNREGISTERED_FILES
-                    return False
+            for event, path in reconcile(self, root, threads or DEFAULT_THREADS,
+                                         skip=db_file_names(self.file_name, root)):
+                events.get(event, self.changed_files).append(path)
         except sqlite3.DatabaseError:
             self.__set_error__(self.ERROR_DATABASE_INTEGRITY)
             return False
-        return True
+        self.unregistered_files = events[EVENT_NEW]
+        self.lost_files = events[EVENT_MISSING]
+        if self.unregistered_files:
+            self.__set_error__(self.ERROR_UNREGISTERED_FILES)
+        if self.lost_files:
+            self.__set_error__(self.ERROR_FILES_LOST)
+        return not self.unregistered_files and not self.lost_files
+
+    def check_unregistered_files(self, root: str = None) -> bool:
+        """Prüft rekursiv, ob Dateien im Verzeichnisbaum nicht in der Datenbank sind."""
+        self.check_files(root)
+        return not self.unregistered_files
+
+    def check_lost_files(self, root: str = None) -> bool:
+        """Prüft, ob in der Datenbank Pfade zu Dateien existieren, die nicht mehr vorhanden sind."""
+        self.check_files(root)
+        return not self.lost_files
 
     def get_stats(self) -> dict:
-        """Gibt Statistiken über die Datenbank zurück."""
-        stats = {
-            "total_images": 0,
-            "images_with_md5": 0,
-            "images_with_image_hash": 0,
-            "images_with_both_hashes": 0,
-            "unregistered_files": len(self.unregistered_files),
-            "double_files": len(self.find_doubles_by_md5())
-        }
+        """Gibt Statistiken über die Datenbank zurück.
+
+        Alle Zähler, auch die Anzahl doppelter MD5-Gruppen und die Einträge
+        je Hash-Verfahren, kommen aus den per Trigger gepflegten Tabellen
+        images_stats und images_algorithm_stats.
+        """
+        stats = self.get_counters()
+        stats["unregistered_files"] = len(self.unregistered_files)
+        stats["double_files"] = stats.pop("double_groups")
+        stats["hash_algorithms"] = self.get_hash_algorithms()
+        return stats
+
+    def get_counters(self) -> dict:
+        """Liest nur die Zähler aus images_stats (STATS_COLUMNS), ohne Index-Zugriffe."""
+        counters = {column: 0 for column in self.STATS_COLUMNS}
         try:
-            with sqlite3.connect(self.file_name) as conn:
-                cursor = conn.execute(f"SELECT {self.KEY_MD5}, {self.KEY_IMAGE} FROM images;")
-                rows = cursor.fetchall()
-                stats["total_images"] = len(rows)
-                for md5, img_hash in rows:
-                    if md5 and md5 != self.VALUE_NONE:
-                        stats["images_with_md5"] += 1
-                    if img_hash and img_hash != self.VALUE_NONE:
-                        stats["images_with_image_hash"] += 1
-                    if md5 and img_hash and md5 != self.VALUE_NONE and img_hash != self.VALUE_NONE:
-                        stats["images_with_both_hashes"] += 1
+            row = self.get_connection().execute(
+                f"SELECT {', '.join(self.STATS_COLUMNS)} FROM images_stats WHERE id = 0;"
+            ).fetchone()
+            if row is None:
+                row = self.get_connection().execute(self._stats_select_sql()).fetchone()
+            counters.update(zip(self.STATS_COLUMNS, row))
         except sqlite3.DatabaseError:
             self.__set_error__(self.ERROR_DATABASE_INTEGRITY)
-        return stats
+        return counters
+
+    def get_change_count(self) -> int:
+        """Zähler aus images_changes, wächst bei jedem geänderten oder gelöschten Eintrag.
+
+        Anders als die Zähler in images_stats auch bei Änderungen, die alle
+        Anzahlen gleich lassen (neuer Hash, Umbenennung); neue Einträge
+        zählen nicht (siehe iter_hashes_since).
+        """
+        row = self.get_connection().execute(
+            "SELECT changes FROM images_changes WHERE id = 0;").fetchone()
+        return row[0] if row is not None else 0
 
-    def find_doubles_by_md5(self) -> list:
-        """Findet doppelte Einträge basierend auf dem MD5-Hash."""
-        doubles = []
+    def get_data_version(self) -> int:
+        """PRAGMA data_version: ändert sich, sobald eine andere Verbindung geschrieben hat."""
+        return self.get_connection().execute("PRAGMA data_version;").fetchone()[0]
+
+    def iter_hashes_since(self, last_id: int = 0) -> Iterator[tuple]:
+        """Streamt (id, md5, image_hash, path) vorhandener Einträge mit id > last_id.
+
+        md5 als 16-Byte-BLOB, image_hash als vorzeichenbehafteter 64-Bit-Wert.
+        """
+        cursor = self.get_connection().execute(f'''
+            SELECT id, {self.KEY_MD5}, {self.KEY_IMAGE}, {self.KEY_PATH} FROM images
+            WHERE id > ? AND {self.KEY_MISSING} = 0 ORDER BY id;
+        ''', (last_id,))
+        yield from cursor
+
+    def get_hash_algorithms(self) -> dict:
+        """{algorithm: Anzahl} der vorhandenen Einträge mit Inhalts-Hash.
+
+        Doppelte werden nur innerhalb eines Verfahrens erkannt; mehr als ein
+        Eintrag heißt, dass die Migration (gen_hashes --migrate-hash) fehlt.
+        Die Anzahlen pflegen Trigger in images_algorithm_stats.
+        """
         try:
-            with sqlite3.connect(self.file_name) as conn:
-                cursor = conn.execute(f'''
-                    SELECT {self.KEY_MD5}, COUNT(*) as count
-                    FROM images
-                    WHERE {self.KEY_MD5} IS NOT NULL AND {self.KEY_MD5} != '{self.VALUE_NONE}'
+            cursor = self.get_connection().execute(
+                "SELECT algorithm, hashed FROM images_algorithm_stats WHERE hashed > 0 ORDER BY algorithm;")
+            return dict(cursor.fetchall())
+        except sqlite3.DatabaseError:
+            self.__set_error__(self.ERROR_DATABASE_INTEGRITY)
+            return {}
+
+    def get_main_hash_algorithm(self) -> str:
+        """Das Hash-Verfahren der meisten Einträge, DEFAULT_HASH_ALGORITHM bei leerer Datenbank."""
+        algorithms = self.get_hash_algorithms()
+        return max(algorithms, key=algorithms.get) if algorithms else self.DEFAULT_HASH_ALGORITHM
+
+    def rebuild_stats(self):
+        """Berechnet die Zähler in images_stats neu aus der Tabelle images."""
+        conn = self.get_connection()
+        with conn:
+            self._rebuild_stats(conn)
+
+    def find_doubles_by_md5(self) -> Iterator[Tuple[str, List[str]]]:
+        """Findet doppelte Einträge basierend auf dem MD5-Hash.
+
+        Generator über (md5, [paths]); eine einzige, über den md5-Index
+        sortierte Abfrage, der Speicherbedarf wächst nicht mit der Anzahl
+        der Gruppen.
+        """
+        try:
+            cursor = self.get_connection().execute(f'''
+                SELECT {self.KEY_MD5}, {self.KEY_PATH} FROM images
+                WHERE {self.KEY_MISSING} = 0 AND {self.KEY_MD5} IN (
+                    SELECT {self.KEY_MD5} FROM images
+                    WHERE {self.KEY_MD5} IS NOT NULL AND {self.KEY_MISSING} = 0
                     GROUP BY {self.KEY_MD5}
-                    HAVING count > 1;
-                ''')
-                rows = cursor.fetchall()
-                for md5, count in rows:
-                    cursor2 = conn.execute(f'''
-                        SELECT {self.KEY_PATH} FROM images WHERE {self.KEY_MD5}=?;
-                    ''', (md5,))
-                    paths = [row[0] for row in cursor2.fetchall()]
-                    doubles.append((md5, paths))
+                    HAVING COUNT(*) > 1)
+                ORDER BY {self.KEY_MD5}, id;
+            ''')
+            current = None
+            paths = []
+            for md5, path in cursor:
+                if md5 != current:
+                    if paths:
+                        yield self.blob_to_md5(current), paths
+                    current = md5
+                    paths = []
+                paths.append(path)
+            if paths:
+                yield self.blob_to_md5(current), paths
         except sqlite3.DatabaseError:
             self.__set_error__(self.ERROR_DATABASE_INTEGRITY)
-        return doubles
-        
+
+    def get_paths_without_md5(self, algorithm: str = None) -> List[str]:
+        """Pfade vorhandener Einträge ohne vollen MD5 (schneller Doppel-Modus).
+
+        Mit algorithm zusätzlich die Einträge, deren Inhalts-Hash mit einem
+        anderen Verfahren berechnet wurde (Migration, siehe update_hashes).
+        Als Liste: die Pfade werden z. B. vom Feeder-Thread eines
+        Prozess-Pools gelesen, die Verbindung gehört aber diesem Thread.
+        """
+        other = f"OR {self.KEY_ALGORITHM} != ?" if algorithm else ""
+        cursor = self.get_connection().execute(f'''
+            SELECT {self.KEY_PATH} FROM images
+            WHERE ({self.KEY_MD5} IS NULL {other}) AND {self.KEY_MISSING} = 0 ORDER BY id;
+        ''', (algorithm,) if algorithm else ())
+        return [path for (path,) in cursor]
+
+    def count_images(self) -> int:
+        """Anzahl der vorhandenen (nicht verschwundenen) Einträge."""
+        try:
+            cursor = self.get_connection().execute(
+                f"SELECT COUNT(*) FROM images WHERE {self.KEY_MISSING} = 0;"
+            )
+            return cursor.fetchone()[0]
+        except sqlite3.DatabaseError:
+            self.__set_error__(self.ERROR_DATABASE_INTEGRITY)
+            return 0
+
+    def count_doubles_by_md5(self) -> int:
+        """Zählt die Gruppen doppelter MD5-Hashes (Zähler double_groups aus images_stats)."""
+        return self.get_counters()["double_groups"]
+
+    def _count_doubles_sql(self) -> str:
+        """Anzahl der MD5-Gruppen mit mehr als einem vorhandenen Eintrag, über den md5-Index."""
+        return f'''
+            SELECT COUNT(*) FROM (
+                SELECT 1 FROM images
+                WHERE {self.KEY_MD5} IS NOT NULL AND {self.KEY_MISSING} = 0
+                GROUP BY {self.KEY_MD5}
+                HAVING COUNT(*) > 1)
+        '''
+
+    # default Hamming distance for near duplicates (of 64 phash bits)
+    DEFAULT_PHASH_DISTANCE = 4
+
+    def _iter_phashes(self, b_archives: bool = False) -> Iterator[Tuple[int, str]]:
+        """(pHash ohne Vorzeichen, path) aller vorhandenen Bilder.
+
+        Mit b_archives aus der Hauptdatenbank und allen angehängten Archiven
+        in einer Abfrage, die Pfade sind dann absolut.
+        """
+        where = f"{self.KEY_IMAGE} IS NOT NULL AND {self.KEY_MISSING} = 0"
+        conn = self.get_connection()
+        if not b_archives:
+            cursor = conn.execute(f'''
+                SELECT {self.KEY_IMAGE}, {self.KEY_PATH} FROM images
+                WHERE {where} ORDER BY id;
+            ''')
+            for image_hash, path in cursor:
+                yield image_hash & self.PHASH_MASK, path
+            return
+        roots = [root for _, _, root in self.get_archives()]
+        cursor = conn.execute(
+            self._archives_sql(f"{self.KEY_IMAGE}, {self.KEY_PATH}, id", where)
+            + " ORDER BY archive, id;")
+        for archive, image_hash, path, _ in cursor:
+            yield image_hash & self.PHASH_MASK, os.path.join(roots[archive], path)
+
+    def build_phash_index(self, b_archives: bool = False) -> CBkTree:
+        """Lädt alle pHashes in einen BK-Baum (Payload ist der Pfad)."""
+        tree = CBkTree()
+        try:
+            for value, path in self._iter_phashes(b_archives):
+                tree.add(value, path)
+        except sqlite3.DatabaseError:
+            self.__set_error__(self.ERROR_DATABASE_INTEGRITY)
+        return tree
+
+    def find_similar_by_phash(self, max_distance: int = DEFAULT_PHASH_DISTANCE,
+                              b_archives: bool = False) -> list:
+        """Findet ähnliche Bilder, deren pHash sich in höchstens max_distance Bits unterscheidet.
+
+        Gibt wie find_doubles_by_md5 eine Liste (image_hash, [paths]) zurück.
+        Jede Gruppe enthält die Bilder eines pHash und aller größeren pHashes
+        in Reichweite, so dass jedes ähnliche Paar genau einmal als Paar
+        (Anker, Nachbar) vorkommt.
+        """
+        tree = self.build_phash_index(b_archives)
+        similar = []
+        for value, paths in sorted(tree.nodes(), key=lambda node: node[0]):
+            group = list(paths)
+            for distance, other, other_paths in sorted(tree.query(value, max_distance)):
+                if other > value:
+                    group.extend(other_paths)
+            if len(group) > 1:
+                similar.append((self.int_to_phash(value), group))
+        return similar
+
+    def find_phash_clusters(self, max_distance: int = DEFAULT_PHASH_DISTANCE,
+                            chunk_size: int = None, b_archives: bool = False) -> list:
+        """Gruppiert alle Bilder in Cluster ähnlicher pHashes (Union-Find, NumPy).
+
+        Anders als find_similar_by_phash liefert jedes Bild genau einen
+        Cluster; Ketten ähnlicher Bilder landen im selben Cluster. Rückgabe
+        wie find_doubles_by_md5: Liste (kleinster image_hash, [paths]).
+        """
+        from phash_cluster import cluster_paths, DEFAULT_CHUNK_SIZE
+
+        hash_paths = {}
+        try:
+            for value, path in self._iter_phashes(b_archives):
+                hash_paths.setdefault(value, []).append(path)
+        except sqlite3.DatabaseError:
+            self.__set_error__(self.ERROR_DATABASE_INTEGRITY)
+            return []
+        clusters = cluster_paths(hash_paths, max_distance, chunk_size or DEFAULT_CHUNK_SIZE)
+        return [(self.int_to_phash(value), paths) for value, paths in clusters]
+
+    # SQLite attaches at most 10 databases by default (SQLITE_MAX_ATTACHED)
+    MAX_ARCHIVES = 10
+
+    def attach_archive(self, file_name: str, root: str = None) -> bool:
+        """Hängt die Hash-Datenbank eines weiteren Archivs (z. B. einer anderen Platte) an.
+
+        root ist das Verzeichnis, zu dem ihre Pfade relativ sind (Standard:
+        Verzeichnis der Datenbank). Die Datenbank wird vorher geprüft und auf
+        das aktuelle Schema migriert.
+        """
+        if len(self.archives) >= self.MAX_ARCHIVES:
+            print(f"Cannot attach {file_name}: at most {self.MAX_ARCHIVES} archives")
+            return False
+        other = CPigDb(file_name)
+        other.root = root
+        error = other.get_error()
+        root = other.get_root()
+        other.close()
+        if error != self.ERROR_STAT_NONE:
+            print(f"Cannot attach {file_name}: {error}")
+            return False
+        alias = f"archive_{len(self.archives) + 1}"
+        try:
+            # archives are only read
+            self.get_connection().execute(f"ATTACH DATABASE ? AS {alias};",
+                                          (self._uri(file_name, read_only=True),))
+        except sqlite3.DatabaseError:
+            self.__set_error__(self.ERROR_DATABASE_INTEGRITY)
+            return False
+        self.archives.append((alias, file_name, root))
+        return True
+
+    def get_archives(self) -> list:
+        """(alias, file_name, root) der Hauptdatenbank und aller angehängten Archive."""
+        return [("main", self.file_name, self.get_root())] + self.archives
+
+    def _archives_sql(self, columns: str, where: str) -> str:
+        # one SELECT per archive, the first column is the archive number
+        return " UNION ALL ".join(
+            f"SELECT {number} AS archive, {columns} FROM {alias}.images WHERE {where}"
+            for number, (alias, _, _) in enumerate(self.get_archives())
+        )
+
+    def find_doubles_across_archives(self, b_cross_only: bool = True) -> Iterator[Tuple[str, List[str]]]:
+        """Findet doppelte Dateien über alle angehängten Archive (MD5).
+
+        Generator über (md5, [absolute paths]) wie find_doubles_by_md5. Die
+        Teilabfragen laufen über die md5-Indizes der einzelnen Datenbanken
+        und werden von SQLite sortiert zusammengeführt. Mit b_cross_only nur
+        Gruppen, die in mehr als einem Archiv vorkommen.
+        """
+        roots = [root for _, _, root in self.get_archives()]
+        try:
+            cursor = self.get_connection().execute(
+                self._archives_sql(f"{self.KEY_MD5}, {self.KEY_PATH}, id",
+                                   f"{self.KEY_MD5} IS NOT NULL AND {self.KEY_MISSING} = 0")
+                + f" ORDER BY {self.KEY_MD5}, archive, id;")
+            current = None
+            group = []
+            for archive, md5, path, _ in cursor:
+                if md5 != current:
+                    if len(group) > 1 and (not b_cross_only or len({a for a, _ in group}) > 1):
+                        yield self.blob_to_md5(current), [path for _, path in group]
+                    current = md5
+                    group = []
+                group.append((archive, os.path.join(roots[archive], path)))
+            if len(group) > 1 and (not b_cross_only or len({a for a, _ in group}) > 1):
+                yield self.blob_to_md5(current), [path for _, path in group]
+        except sqlite3.DatabaseError:
+            self.__set_error__(self.ERROR_DATABASE_INTEGRITY)
+
     def get_unregistered_files(self) -> list:
         """Gibt eine Liste der unregistrierten Dateien zurück."""
         return self.unregistered_files
 
+    def get_lost_files(self) -> list:
+        """Gibt eine Liste der verlorenen Dateien zurück."""
+        return self.lost_files
+
+    def get_changed_files(self) -> list:
+        """Gibt eine Liste der seit dem Hashen geänderten Dateien zurück."""
+        return self.changed_files
+
     def delete_file_entry(self, md5_hash: str, path: str) -> bool:
         """Löscht einen Eintrag aus der Datenbank basierend auf dem MD5-Hash und Pfad."""
         try:
-            with sqlite3.connect(self.file_name) as conn:
+            with self.get_connection() as conn:
                 conn.execute(f'''
                     DELETE FROM images WHERE {self.KEY_MD5}=? AND {self.KEY_PATH}=?
-                ''', (md5_hash, path))
+                ''', (self.md5_to_blob(md5_hash), path))
             # delete file in dir
-            file_path = f"{os.path.dirname(self.file_name)}/{Path(path)}"
+            file_path = os.path.join(self.get_root(), path)
             try:
                 #print(file_path)
                 os.remove(file_path)
@@ -191,37 +601,537 @@ class CPigDb:
             self.__set_error__(self.ERROR_DATABASE_INTEGRITY)
             return False
 
+    def delete_entries(self, paths: list) -> int:
+        """Löscht die Einträge vieler Pfade in einer Transaktion (Dateien bleiben unberührt)."""
+        try:
+            conn = self.get_connection()
+            with conn:
+                cursor = conn.executemany(
+                    f"DELETE FROM images WHERE {self.KEY_PATH}=?",
+                    ((path,) for path in paths)
+                )
+            return cursor.rowcount
+        except sqlite3.DatabaseError:
+            self.__set_error__(self.ERROR_DATABASE_INTEGRITY)
+            return 0
+
+    def export_index(self, file_name: str = None, algorithm: str = None) -> Tuple[int, int]:
+        """Schreibt den kompakten Binärindex (CHashIndex) neben die Datenbank.
+
+        Standard-Dateiname ist der der Datenbank mit Endung .idx. Der Index
+        enthält nur MD5-Einträge des Verfahrens algorithm (Standard: das der
+        meisten Einträge) und vermerkt es im Header. Gibt die Anzahl der
+        MD5- und pHash-Einträge zurück.
+        """
+        from CHashIndex import CHashIndex
+
+        algorithm = algorithm or self.get_main_hash_algorithm()
+        conn = self.get_connection()
+        where = f"{self.KEY_MISSING} = 0"
+        paths = conn.execute(f"SELECT id, {self.KEY_PATH} FROM images WHERE {where};")
+        md5_rows = conn.execute(f'''
+            SELECT {self.KEY_MD5}, id FROM images
+            WHERE {self.KEY_MD5} IS NOT NULL AND {self.KEY_ALGORITHM} = ? AND {where}
+            ORDER BY {self.KEY_MD5}, id;
+        ''', (algorithm,))
+        # negative values are the upper half of the unsigned 64 bit range
+        phash_rows = conn.execute(f'''
+            SELECT {self.KEY_IMAGE}, id FROM images
+            WHERE {self.KEY_IMAGE} IS NOT NULL AND {where}
+            ORDER BY {self.KEY_IMAGE} < 0, {self.KEY_IMAGE}, id;
+        ''')
+        return CHashIndex.write(file_name or CHashIndex.default_file_name(self.file_name), paths,
+                                md5_rows,
+                                ((value & self.PHASH_MASK, row_id) for value, row_id in phash_rows),
+                                algorithm)
+
+    def get_root(self) -> str:
+        """Verzeichnis, zu dem die gespeicherten Pfade relativ sind (Standard: das der Datenbank)."""
+        return os.path.abspath(self.root or os.path.dirname(os.path.abspath(self.file_name)))
+
+    PHASH_MASK = (1 << 64) - 1
+
+    @staticmethod
+    def md5_to_blob(md5_hash):
+        """Hex-MD5 (oder bytes) -> 16-Byte-BLOB, None/'None' -> None."""
+        if md5_hash is None or md5_hash == CPigDb.VALUE_NONE:
+            return None
+        if isinstance(md5_hash, (bytes, bytearray)):
+            return bytes(md5_hash)
+        return bytes.fromhex(md5_hash)
+
+    @staticmethod
+    def blob_to_md5(blob):
+        """16-Byte-BLOB -> Hex-MD5."""
+        return None if blob is None else blob.hex()
+
+    @staticmethod
+    def phash_to_int(image_hash):
+        """pHash (Hex-Text, ImageHash oder int) -> vorzeichenbehafteter 64-Bit-Wert für SQLite."""
+        if image_hash is None or image_hash == CPigDb.VALUE_NONE:
+            return None
+        if not isinstance(image_hash, int):
+            image_hash = int(str(image_hash), 16)
+        image_hash &= CPigDb.PHASH_MASK
+        return image_hash - (1 << 64) if image_hash >= (1 << 63) else image_hash
+
+    @staticmethod
+    def int_to_phash(value) -> str:
+        """Gespeicherter 64-Bit-Wert -> pHash als Hex-Text."""
+        return None if value is None else f"{value & CPigDb.PHASH_MASK:016x}"
+
+    def _table_sql(self, table: str) -> str:
+        sql=f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        sql+=f"{self.KEY_MD5} BLOB,"
+        sql+=f"{self.KEY_IMAGE} INTEGER,"
+        sql+=f"{self.KEY_PATH} TEXT UNIQUE,"
+        sql+=f"{self.KEY_SIZE} INTEGER,"
+        sql+=f"{self.KEY_MTIME_NS} INTEGER,"
+        sql+=f"{self.KEY_INODE} INTEGER,"
+        sql+=f"{self.KEY_DEVICE} INTEGER,"
+        sql+=f"{self.KEY_MISSING} INTEGER NOT NULL DEFAULT 0,"
+        sql+=f"{self.KEY_PARTIAL} BLOB,"
+        sql+=f"{self.KEY_ALGORITHM} TEXT NOT NULL DEFAULT '{self.DEFAULT_HASH_ALGORITHM}'"
+        sql+=")"
+        return sql
+
+    def _create_indexes(self, conn):
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_images_md5 ON images ({self.KEY_MD5});")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_images_phash ON images ({self.KEY_IMAGE});")
+
+    def _stats_expressions(self, row: str) -> list:
+        """SQL-Ausdrücke (0/1) der Zähler für eine Zeile (NEW, OLD oder images)."""
+        present = f"{row}.{self.KEY_MISSING} = 0"
+        return [
+            f"({present})",
+            f"({present} AND {row}.{self.KEY_MD5} IS NOT NULL)",
+            f"({present} AND {row}.{self.KEY_IMAGE} IS NOT NULL)",
+            f"({present} AND {row}.{self.KEY_MD5} IS NOT NULL AND {row}.{self.KEY_IMAGE} IS NOT NULL)",
+            f"({row}.{self.KEY_MISSING} != 0)",
+        ]
+
+    def _stats_sums(self) -> str:
+        """Die Zähler (STATS_COLUMNS) als Summen über die Tabelle images."""
+        sums = [f"COALESCE(SUM({expr}), 0)" for expr in self._stats_expressions("images")]
+        sums.append(f"({self._count_doubles_sql()})")
+        return ", ".join(sums)
+
+    def _md5_count_sql(self, row: str) -> str:
+        """Vorhandene Einträge mit dem MD5 von row (NEW/OLD), gezählt bis 3 über den md5-Index."""
+        return (f"(SELECT COUNT(*) FROM (SELECT 1 FROM images "
+                f"WHERE {self.KEY_MD5} = {row}.{self.KEY_MD5} AND {self.KEY_MISSING} = 0 LIMIT 3))")
+
+    def _stats_select_sql(self) -> str:
+        return f"SELECT {self._stats_sums()} FROM images;"
+
+    def _hashed_sql(self, row: str) -> str:
+        """row (NEW/OLD) ist vorhanden und hat einen Inhalts-Hash."""
+        return f"{row}.{self.KEY_MISSING} = 0 AND {row}.{self.KEY_MD5} IS NOT NULL"
+
+    def _rebuild_stats(self, conn):
+        conn.execute(
+            f"INSERT OR REPLACE INTO images_stats (id, {', '.join(self.STATS_COLUMNS)}) "
+            f"SELECT 0, {self._stats_sums()} FROM images;"
+        )
+        conn.execute("DELETE FROM images_algorithm_stats;")
+        conn.execute(
+            f"INSERT INTO images_algorithm_stats (algorithm, hashed) "
+            f"SELECT {self.KEY_ALGORITHM}, COUNT(*) FROM images WHERE {self._hashed_sql('images')} "
+            f"GROUP BY {self.KEY_ALGORITHM};"
+        )
+
+    def _create_stats(self, conn):
+        """Legt images_stats mit den Triggern an, die die Zähler pflegen."""
+        columns = ", ".join(f"{column} INTEGER NOT NULL DEFAULT 0" for column in self.STATS_COLUMNS)
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS images_stats (id INTEGER PRIMARY KEY CHECK (id = 0), {columns});"
+        )
+        new = self._stats_expressions("NEW")
+        old = self._stats_expressions("OLD")
+        add = ", ".join(f"{c} = {c} + {e}" for c, e in zip(self.ROW_STATS_COLUMNS, new))
+        sub = ", ".join(f"{c} = {c} - {e}" for c, e in zip(self.ROW_STATS_COLUMNS, old))
+        change = ", ".join(f"{c} = {c} - {o} + {n}"
+                           for c, o, n in zip(self.ROW_STATS_COLUMNS, old, new))
+        conn.execute("DROP TRIGGER IF EXISTS images_stats_insert;")
+        conn.execute("DROP TRIGGER IF EXISTS images_stats_delete;")
+        conn.execute("DROP TRIGGER IF EXISTS images_stats_update;")
+        conn.execute(f'''
+            CREATE TRIGGER images_stats_insert AFTER INSERT ON images BEGIN
+                UPDATE images_stats SET {add} WHERE id = 0;
+            END;
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER images_stats_delete AFTER DELETE ON images BEGIN
+                UPDATE images_stats SET {sub} WHERE id = 0;
+            END;
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER images_stats_update
+            AFTER UPDATE OF {self.KEY_MD5}, {self.KEY_IMAGE}, {self.KEY_MISSING} ON images BEGIN
+                UPDATE images_stats SET {change} WHERE id = 0;
+            END;
+        ''')
+        self._create_doubles_triggers(conn)
+        self._create_algorithm_triggers(conn)
+        self._create_change_counter(conn)
+        self._rebuild_stats(conn)
+
+    def _create_change_counter(self, conn):
+        """images_changes mit den Triggern, die jede Änderung und Löschung zählen.
+
+        Der Zähler wird von rebuild_stats nicht zurückgesetzt, er wächst nur.
+        """
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS images_changes "
+            "(id INTEGER PRIMARY KEY CHECK (id = 0), changes INTEGER NOT NULL DEFAULT 0);"
+        )
+        conn.execute("INSERT OR IGNORE INTO images_changes (id, changes) VALUES (0, 0);")
+        bump = "UPDATE images_changes SET changes = changes + 1 WHERE id = 0"
+        conn.execute("DROP TRIGGER IF EXISTS images_changes_update;")
+        conn.execute("DROP TRIGGER IF EXISTS images_changes_delete;")
+        conn.execute(f"CREATE TRIGGER images_changes_update AFTER UPDATE ON images BEGIN {bump}; END;")
+        conn.execute(f"CREATE TRIGGER images_changes_delete AFTER DELETE ON images BEGIN {bump}; END;")
+
+    def _create_algorithm_triggers(self, conn):
+        """images_algorithm_stats mit den Triggern für die Anzahl je hash_algorithm."""
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS images_algorithm_stats "
+            "(algorithm TEXT PRIMARY KEY, hashed INTEGER NOT NULL DEFAULT 0);"
+        )
+        algorithm = self.KEY_ALGORITHM
+        add = (f"INSERT INTO images_algorithm_stats (algorithm, hashed) VALUES (NEW.{algorithm}, 1) "
+               f"ON CONFLICT (algorithm) DO UPDATE SET hashed = hashed + 1")
+        sub = f"UPDATE images_algorithm_stats SET hashed = hashed - 1 WHERE algorithm = OLD.{algorithm}"
+        conn.execute("DROP TRIGGER IF EXISTS images_algorithm_insert;")
+        conn.execute("DROP TRIGGER IF EXISTS images_algorithm_delete;")
+        conn.execute("DROP TRIGGER IF EXISTS images_algorithm_update_old;")
+        conn.execute("DROP TRIGGER IF EXISTS images_algorithm_update_new;")
+        conn.execute(f'''
+            CREATE TRIGGER images_algorithm_insert AFTER INSERT ON images
+            WHEN {self._hashed_sql('NEW')} BEGIN {add}; END;
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER images_algorithm_delete AFTER DELETE ON images
+            WHEN {self._hashed_sql('OLD')} BEGIN {sub}; END;
+        ''')
+        # an update moves the entry from the old to the new count
+        updated = f"AFTER UPDATE OF {self.KEY_MD5}, {self.KEY_MISSING}, {algorithm} ON images"
+        conn.execute(f'''
+            CREATE TRIGGER images_algorithm_update_old {updated}
+            WHEN {self._hashed_sql('OLD')} BEGIN {sub}; END;
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER images_algorithm_update_new {updated}
+            WHEN {self._hashed_sql('NEW')} BEGIN {add}; END;
+        ''')
+
+    def _create_doubles_triggers(self, conn):
+        """Trigger für double_groups: ein vorhandener Eintrag kommt zu einem MD5
+        hinzu oder verlässt ihn; die Gruppe zählt, wenn dabei die Anzahl über
+        den md5-Index die Grenze 2 überschreitet."""
+        md5, missing = self.KEY_MD5, self.KEY_MISSING
+        joins = f"NEW.{missing} = 0 AND NEW.{md5} IS NOT NULL AND {self._md5_count_sql('NEW')} = 2"
+        leaves = f"OLD.{missing} = 0 AND OLD.{md5} IS NOT NULL AND {self._md5_count_sql('OLD')} = 1"
+        conn.execute("DROP TRIGGER IF EXISTS images_doubles_insert;")
+        conn.execute("DROP TRIGGER IF EXISTS images_doubles_delete;")
+        conn.execute("DROP TRIGGER IF EXISTS images_doubles_update;")
+        conn.execute(f'''
+            CREATE TRIGGER images_doubles_insert AFTER INSERT ON images BEGIN
+                UPDATE images_stats SET double_groups = double_groups + 1
+                WHERE id = 0 AND {joins};
+            END;
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER images_doubles_delete AFTER DELETE ON images BEGIN
+                UPDATE images_stats SET double_groups = double_groups - 1
+                WHERE id = 0 AND {leaves};
+            END;
+        ''')
+        # only if md5 or presence changed: leave the old md5, join the new one
+        conn.execute(f'''
+            CREATE TRIGGER images_doubles_update AFTER UPDATE OF {md5}, {missing} ON images
+            WHEN OLD.{md5} IS NOT NEW.{md5} OR (OLD.{missing} = 0) != (NEW.{missing} = 0) BEGIN
+                UPDATE images_stats SET double_groups = double_groups - 1
+                WHERE id = 0 AND {leaves};
+                UPDATE images_stats SET double_groups = double_groups + 1
+                WHERE id = 0 AND {joins};
+            END;
+        ''')
+
     def _create_table(self):
+        exists = self.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name='images';"
+        ).fetchone() is not None
+        if exists:
+            self._migrate_schema(self.conn)
+            return
         with self.conn:
-            sql="CREATE TABLE IF NOT EXISTS images (id INTEGER PRIMARY KEY AUTOINCREMENT,"
-            sql+=f"{self.KEY_MD5} TEXT,"
-            sql+=f"{self.KEY_IMAGE} TEXT,"
-            sql+=f"{self.KEY_PATH} TEXT UNIQUE"
-            sql+=")"
-            self.conn.execute(sql)
-            
-    def insert_image(self, md5_hash: str, image_hash: str, path: str):
-        with self.conn:
-            self.conn.execute(f'''
-                INSERT OR IGNORE INTO images ({self.KEY_MD5}, {self.KEY_IMAGE}, {self.KEY_PATH})
-                VALUES (?, ?, ?)
-            ''', (md5_hash, image_hash, path))
+            self.conn.execute(self._table_sql("images"))
+            self._create_indexes(self.conn)
+            self._create_stats(self.conn)
+            self.conn.execute(f"PRAGMA user_version={self.SCHEMA_VERSION};")
+
+    def _needs_migration(self, conn) -> bool:
+        return conn.execute("PRAGMA user_version;").fetchone()[0] < self.SCHEMA_VERSION
+
+    def _migrate_schema(self, conn):
+        """Migriert die Tabelle images in-place auf SCHEMA_VERSION."""
+        version = conn.execute("PRAGMA user_version;").fetchone()[0]
+        if version >= self.SCHEMA_VERSION:
+            return
+        print(f"Migrating database {self.file_name} to schema version {self.SCHEMA_VERSION} ...")
+        if version < 2:
+            # the rebuilt table already has all columns of the current layout
+            self._rebuild_table(conn)
+
+        conn.commit()
+        conn.execute("BEGIN;")
+        try:
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(images);")}
+            if self.KEY_PARTIAL not in columns:
+                conn.execute(f"ALTER TABLE images ADD COLUMN {self.KEY_PARTIAL} BLOB;")
+            if self.KEY_ALGORITHM not in columns:
+                # all existing hashes are md5
+                conn.execute(f"ALTER TABLE images ADD COLUMN {self.KEY_ALGORITHM} TEXT "
+                             f"NOT NULL DEFAULT '{self.DEFAULT_HASH_ALGORITHM}';")
+            if version < 8:
+                stats_columns = {row[1] for row in conn.execute("PRAGMA table_info(images_stats);")}
+                if stats_columns and "double_groups" not in stats_columns:
+                    conn.execute("ALTER TABLE images_stats ADD COLUMN double_groups "
+                                 "INTEGER NOT NULL DEFAULT 0;")
+                # (re)creates the tables, all triggers and the counters
+                self._create_stats(conn)
+            conn.execute(f"PRAGMA user_version={self.SCHEMA_VERSION};")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _rebuild_table(self, conn):
+        """Schreibt eine Tabelle mit Text-Hashes (Version 1) in das aktuelle Format um."""
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(images);")}
+        select = [self.KEY_MD5, self.KEY_IMAGE, self.KEY_PATH]
+        select += [c if c in columns else "NULL" for c in self.FINGERPRINT_COLUMNS]
+        select.append(self.KEY_MISSING if self.KEY_MISSING in columns else "0")
+
+        conn.commit()
+        conn.execute("BEGIN;")
+        try:
+            conn.execute("DROP TABLE IF EXISTS images_migrate;")
+            conn.execute(self._table_sql("images_migrate"))
+            cursor = conn.execute(f"SELECT {', '.join(select)} FROM images ORDER BY id;")
+            insert = f'''
+                INSERT INTO images_migrate ({self.KEY_MD5}, {self.KEY_IMAGE}, {self.KEY_PATH},
+                    {self.KEY_SIZE}, {self.KEY_MTIME_NS}, {self.KEY_INODE}, {self.KEY_DEVICE},
+                    {self.KEY_MISSING})
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            '''
+            while True:
+                rows = cursor.fetchmany(self.DEFAULT_BATCH_SIZE)
+                if not rows:
+                    break
+                conn.executemany(insert, (
+                    (self.md5_to_blob(md5), self.phash_to_int(image_hash)) + tuple(rest)
+                    for md5, image_hash, *rest in rows
+                ))
+            conn.execute("DROP TABLE images;")
+            conn.execute("ALTER TABLE images_migrate RENAME TO images;")
+            self._create_indexes(conn)
+            conn.execute("PRAGMA user_version=2;")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        # give the space of the text hashes back to the file system
+        conn.execute("VACUUM;")
+
+    # fixed statement texts, so the connection reuses the prepared statements
+    SQL_INSERT = f'''
+        INSERT OR IGNORE INTO images ({KEY_MD5}, {KEY_IMAGE}, {KEY_PATH},
+            {KEY_SIZE}, {KEY_MTIME_NS}, {KEY_INODE}, {KEY_DEVICE}, {KEY_PARTIAL}, {KEY_ALGORITHM})
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+    SQL_UPSERT = f'''
+        INSERT INTO images ({KEY_MD5}, {KEY_IMAGE}, {KEY_PATH},
+            {KEY_SIZE}, {KEY_MTIME_NS}, {KEY_INODE}, {KEY_DEVICE}, {KEY_PARTIAL}, {KEY_ALGORITHM},
+            {KEY_MISSING})
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+        ON CONFLICT({KEY_PATH}) DO UPDATE SET
+            {KEY_MD5}=excluded.{KEY_MD5},
+            {KEY_IMAGE}=excluded.{KEY_IMAGE},
+            {KEY_SIZE}=excluded.{KEY_SIZE},
+            {KEY_MTIME_NS}=excluded.{KEY_MTIME_NS},
+            {KEY_INODE}=excluded.{KEY_INODE},
+            {KEY_DEVICE}=excluded.{KEY_DEVICE},
+            {KEY_PARTIAL}=excluded.{KEY_PARTIAL},
+            {KEY_ALGORITHM}=excluded.{KEY_ALGORITHM},
+            {KEY_MISSING}=0
+    '''
+
+    @staticmethod
+    def _image_row(md5_hash: str, image_hash: str, path: str, fingerprint: tuple = None,
+                   partial_hash: str = None, algorithm: str = None) -> tuple:
+        size, mtime_ns, inode, device = fingerprint or (None, None, None, None)
+        return (CPigDb.md5_to_blob(md5_hash), CPigDb.phash_to_int(image_hash), path,
+                size, mtime_ns, inode, device, CPigDb.md5_to_blob(partial_hash),
+                algorithm or CPigDb.DEFAULT_HASH_ALGORITHM)
+
+    def insert_image(self, md5_hash: str, image_hash: str, path: str, fingerprint: tuple = None,
+                     partial_hash: str = None, algorithm: str = None):
+        """Fügt einen Eintrag ein; vorhandene Pfade bleiben unverändert.
+
+        fingerprint ist optional (size, mtime_ns, inode, device), partial_hash
+        der Hash von Anfang und Ende der Datei aus dem schnellen Doppel-Modus,
+        algorithm der Inhalts-Hash von md5_hash und partial_hash (Standard: md5).
+        """
+        conn = self.get_connection()
+        with conn:
+            conn.execute(self.SQL_INSERT, self._image_row(md5_hash, image_hash, path, fingerprint,
+                                                          partial_hash, algorithm))
+
+    def upsert_image(self, md5_hash: str, image_hash: str, path: str, fingerprint: tuple = None,
+                     partial_hash: str = None, algorithm: str = None):
+        """Fügt einen Eintrag ein oder ersetzt Hashes und Fingerprint eines vorhandenen Pfads."""
+        conn = self.get_connection()
+        with conn:
+            conn.execute(self.SQL_UPSERT, self._image_row(md5_hash, image_hash, path, fingerprint,
+                                                          partial_hash, algorithm))
+
+    def insert_images(self, rows, batch_size: int = None) -> int:
+        """Fügt viele Einträge (md5_hash, image_hash, path[, fingerprint[, partial_hash[, algorithm]]]) ein.
+
+        rows darf ein Generator sein; je batch_size Zeilen wird eine
+        Transaktion mit executemany geschrieben. Gibt die Anzahl Zeilen zurück.
+        """
+        return self._write_batches(self.SQL_INSERT, rows, batch_size)
+
+    def upsert_images(self, rows, batch_size: int = None) -> int:
+        """Wie insert_images, ersetzt aber vorhandene Pfade (siehe upsert_image)."""
+        return self._write_batches(self.SQL_UPSERT, rows, batch_size)
+
+    def _write_batches(self, sql: str, rows, batch_size: int = None) -> int:
+        if batch_size is None:
+            batch_size = self.DEFAULT_BATCH_SIZE
+        conn = self.get_connection()
+        rows = (self._image_row(*row) for row in rows)
+        count = 0
+        while True:
+            batch = list(itertools.islice(rows, max(1, batch_size)))
+            if not batch:
+                return count
+            start = time.perf_counter()
+            with conn:
+                conn.executemany(sql, batch)
+            if self.profiler is not None:
+                self.profiler.add("db_write", time.perf_counter() - start, files=len(batch))
+            count += len(batch)
 
-    def update_hashes(self, path: str, md5_hash: str = None, image_hash: str = None):
-        """Setzt nachträglich md5 und/oder image hash für einen gegebenen Pfad."""
+    def get_fingerprints(self) -> dict:
+        """Gibt {path: (size, mtime_ns, inode, device, missing)} für alle Einträge zurück."""
+        cursor = self.get_connection().execute(f'''
+            SELECT {self.KEY_PATH}, {self.KEY_SIZE}, {self.KEY_MTIME_NS},
+                {self.KEY_INODE}, {self.KEY_DEVICE}, {self.KEY_MISSING}
+            FROM images;
+        ''')
+        return {row[0]: tuple(row[1:]) for row in cursor}
+
+    def get_path_fingerprints(self, paths) -> dict:
+        """Gibt {path: (size, mtime_ns)} der gegebenen Pfade zurück, wie beim Hashen gespeichert.
+
+        Pfade ohne Eintrag fehlen im Ergebnis; Einträge ohne Fingerprint
+        (ältere Datenbanken) haben (None, None).
+        """
+        conn = self.get_connection()
+        sql = f"SELECT {self.KEY_SIZE}, {self.KEY_MTIME_NS} FROM images WHERE {self.KEY_PATH}=?"
+        fingerprints = {}
+        for path in paths:
+            row = conn.execute(sql, (path,)).fetchone()
+            if row is not None:
+                fingerprints[path] = tuple(row)
+        return fingerprints
+
+    def mark_missing(self, paths: list, missing: bool = True):
+        """Markiert Einträge als verschwunden (oder wieder vorhanden)."""
+        conn = self.get_connection()
+        with conn:
+            conn.executemany(
+                f"UPDATE images SET {self.KEY_MISSING}=? WHERE {self.KEY_PATH}=?",
+                ((int(missing), path) for path in paths)
+            )
+
+    def mark_missing_under(self, directory: str) -> int:
+        """Markiert alle Einträge unterhalb eines Verzeichnisses als verschwunden."""
+        prefix = directory.rstrip("/") + "/"
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.execute(
+                f"UPDATE images SET {self.KEY_MISSING}=1 "
+                f"WHERE substr({self.KEY_PATH}, 1, ?) = ? AND {self.KEY_MISSING} = 0",
+                (len(prefix), prefix)
+            )
+        return cursor.rowcount
+
+    def rename_paths(self, renames: list) -> list:
+        """Benennt Einträge um, ohne neu zu hashen: Liste von (alt, neu, ist_verzeichnis).
+
+        Alles in einer Transaktion und in der gegebenen Reihenfolge. Ein
+        vorhandener Eintrag am Ziel wird ersetzt (überschriebene Datei), bei
+        Verzeichnissen werden alle Pfade darunter umgeschrieben. Gibt die
+        Datei-Umbenennungen zurück, deren alter Pfad keinen Eintrag hatte.
+        """
+        unknown = []
+        conn = self.get_connection()
+        with conn:
+            for old, new, is_dir in renames:
+                if not is_dir:
+                    conn.execute(f"DELETE FROM images WHERE {self.KEY_PATH}=?", (new,))
+                    cursor = conn.execute(
+                        f"UPDATE images SET {self.KEY_PATH}=? WHERE {self.KEY_PATH}=?", (new, old))
+                    if cursor.rowcount == 0:
+                        unknown.append((old, new))
+                    continue
+                old_prefix = old.rstrip("/") + "/"
+                new_prefix = new.rstrip("/") + "/"
+                moved = f"? || substr({self.KEY_PATH}, ?)"
+                under = f"substr({self.KEY_PATH}, 1, ?) = ?"
+                args = (new_prefix, len(old_prefix) + 1, len(old_prefix), old_prefix)
+                conn.execute(
+                    f"DELETE FROM images WHERE {self.KEY_PATH} IN "
+                    f"(SELECT {moved} FROM images WHERE {under})", args)
+                conn.execute(f"UPDATE images SET {self.KEY_PATH} = {moved} WHERE {under}", args)
+        return unknown
+
+    def update_hashes(self, path: str, md5_hash: str = None, image_hash: str = None,
+                      partial_hash: str = None, algorithm: str = None):
+        """Setzt nachträglich md5, image hash und/oder partial hash für einen gegebenen Pfad.
+
+        So lässt sich z.B. der volle MD5 für Einträge aus dem schnellen
+        Doppel-Modus nachtragen (siehe get_paths_without_md5). Mit algorithm
+        wird der Inhalts-Hash auf ein anderes Verfahren umgestellt; ein
+        partial hash des alten Verfahrens wird dann verworfen.
+        """
         fields = []
         values = []
+        if algorithm is not None:
+            fields.append(f"{self.KEY_ALGORITHM}=?")
+            values.append(algorithm)
+            if partial_hash is None:
+                fields.append(f"{self.KEY_PARTIAL}=NULL")
+        if partial_hash is not None:
+            fields.append(f"{self.KEY_PARTIAL}=?")
+            values.append(self.md5_to_blob(partial_hash))
         if md5_hash is not None:
             fields.append(f"{self.KEY_MD5}=?")
-            values.append(md5_hash)
+            values.append(self.md5_to_blob(md5_hash))
         if image_hash is not None:
             fields.append(f"{self.KEY_IMAGE}=?")
-            values.append(image_hash)
+            values.append(self.phash_to_int(image_hash))
         if not fields:
             return  # Nichts zu aktualisieren
         values.append(path)
-        with self.conn:
-            self.conn.execute(
+        conn = self.get_connection()
+        with conn:
+            conn.execute(
                 f"UPDATE images SET {', '.join(fields)} WHERE {self.KEY_PATH}=?",
                 values
             )
\ No newline at end of file
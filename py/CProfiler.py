@@ -0,0 +1,169 @@
+##############################################################################
+# Per-stage instrumentation for gen_hashes and consistence-check.
+#
+# Stages (walk, read, md5, decode, phash, db_write, CPigDb queries, ...)
+# accumulate time, calls, bytes and files. Timings measured in worker
+# processes are sent back as plain dicts and merged with add_timings().
+# At the end report() / write_json() give cumulative time, throughput in
+# bytes/s and files/s and the slowest files; with an interval set,
+# tick() prints a one-line summary to stderr while the run is going.
+# Measurements may come from several threads (the gen_hashes stages).
+##############################################################################
+
+import functools
+import heapq
+import inspect
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+class CProfiler:
+    DEFAULT_SLOWEST = 20
+
+    def __init__(self, interval: float = 0.0, slowest: int = DEFAULT_SLOWEST):
+        self.interval = interval
+        self.slowest = slowest
+        self.stages = {}
+        self.slowest_files = []  # min-heap of (seconds, path)
+        self.files = 0
+        self.start = time.perf_counter()
+        self.last_tick = self.start
+        self.lock = threading.RLock()
+
+    def _stage(self, name: str) -> dict:
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = {"seconds": 0.0, "calls": 0, "bytes": 0, "files": 0}
+                self.stages[name] = stage
+            return stage
+
+    def add(self, name: str, seconds: float, nbytes: int = 0, files: int = 0) -> None:
+        """Add one measurement to a stage."""
+        with self.lock:
+            stage = self._stage(name)
+            stage["seconds"] += seconds
+            stage["calls"] += 1
+            stage["bytes"] += nbytes
+            stage["files"] += files
+        self.tick()
+
+    def add_timings(self, timings: dict, path=None, nbytes: int = 0) -> None:
+        """Merge {stage: seconds} of one file (e.g. from a worker process)."""
+        total = 0.0
+        with self.lock:
+            for name, seconds in timings.items():
+                self.add(name, seconds, nbytes, 1)
+                total += seconds
+            self.files += 1
+            if path is not None:
+                self.add_file(path, total)
+        self.tick()
+
+    def add_file(self, path, seconds: float) -> None:
+        """Keep the path if it is among the slowest files."""
+        item = (seconds, str(path))
+        with self.lock:
+            if len(self.slowest_files) < self.slowest:
+                heapq.heappush(self.slowest_files, item)
+            elif item > self.slowest_files[0]:
+                heapq.heapreplace(self.slowest_files, item)
+
+    @contextmanager
+    def timed(self, name: str, nbytes: int = 0, files: int = 0):
+        """Time the body of a with block as one call of a stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, nbytes, files)
+
+    def timed_iter(self, name: str, iterable):
+        """Yield from iterable, timing only the time spent to produce the items."""
+        iterator = iter(iterable)
+        stage = self._stage(name)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                stage["seconds"] += time.perf_counter() - start
+                return
+            stage["seconds"] += time.perf_counter() - start
+            stage["calls"] += 1
+            self.tick()
+            yield item
+
+    def instrument(self, obj, names) -> None:
+        """Replace methods of obj by timed wrappers (generators are timed until exhausted)."""
+        for name in names:
+            method = getattr(obj, name)
+            if inspect.isgeneratorfunction(method):
+                wrapper = functools.partial(self._timed_generator, name, method)
+            else:
+                wrapper = self._timed_call(name, method)
+            setattr(obj, name, wrapper)
+
+    def _timed_call(self, name, method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            with self.timed(name):
+                return method(*args, **kwargs)
+        return wrapper
+
+    def _timed_generator(self, name, method, *args, **kwargs):
+        yield from self.timed_iter(name, method(*args, **kwargs))
+
+    def tick(self) -> None:
+        """Print the periodic summary if the interval has passed."""
+        if self.interval <= 0:
+            return
+        now = time.perf_counter()
+        if now - self.last_tick < self.interval:
+            return
+        self.last_tick = now
+        elapsed = now - self.start
+        # runs without per-file timings (e.g. consistence-check) only have stages
+        parts = [f"{self.files / elapsed:.1f} files/s"] if self.files else []
+        with self.lock:
+            stages = list(self.stages.items())
+        for name, stage in stages:
+            parts.append(f"{name} {stage['seconds']:.1f}s")
+        print(f"[profile {elapsed:.0f}s] " + ", ".join(parts), file=sys.stderr)
+
+    def report(self) -> dict:
+        """Cumulative stage times with throughput and the slowest files."""
+        elapsed = time.perf_counter() - self.start
+        stages = {}
+        with self.lock:
+            items = list(self.stages.items())
+        for name, stage in items:
+            seconds = stage["seconds"]
+            stages[name] = {
+                "seconds": round(seconds, 4),
+                "calls": stage["calls"],
+                "bytes": stage["bytes"],
+                "files": stage["files"],
+                "bytes_per_s": round(stage["bytes"] / seconds, 1)
+                               if seconds and stage["bytes"] else None,
+                "files_per_s": round(stage["files"] / seconds, 1)
+                               if seconds and stage["files"] else None,
+            }
+        return {
+            "elapsed_s": round(elapsed, 4),
+            "files": self.files,
+            "files_per_s": round(self.files / elapsed, 1) if elapsed else None,
+            "stages": stages,
+            "slowest_files": [{"path": path, "seconds": round(seconds, 4)}
+                              for seconds, path in sorted(self.slowest_files, reverse=True)],
+        }
+
+    def write_json(self, file_name: str) -> dict:
+        report = self.report()
+        with open(file_name, "w") as report_file:
+            json.dump(report, report_file, indent=4)
+        print(f"Profile saved to: {file_name}", file=sys.stderr)
+        return report
@@ -0,0 +1,253 @@
+##############################################################################
+# Keeps a CPigDb current from inotify events (Linux), without rescans.
+#
+# Every directory below the root gets a watch. Events only update a pending
+# change set: files to hash (created, written, moved in), files gone
+# (deleted, moved out) and renames (moved inside the tree, files and whole
+# directories). A burst of events, e.g. a camera card import, is collected
+# until no event came for `debounce` seconds (or `max_delay` passed) and
+# then applied in one go: renames as path updates without rehashing, gone
+# files marked missing, the rest hashed and upserted in batches.
+# If the kernel event queue overflows, resync() (e.g. gen_hashes
+# --incremental) is called once to catch up.
+##############################################################################
+
+import os
+import stat
+import time
+from pathlib import Path
+
+from CInotify import CInotify
+from CPigDb import CPigDb
+
+
+class CTreeWatcher:
+    WATCH_MASK = (CInotify.IN_CLOSE_WRITE | CInotify.IN_CREATE | CInotify.IN_DELETE
+                  | CInotify.IN_MOVED_FROM | CInotify.IN_MOVED_TO
+                  | CInotify.IN_ONLYDIR | CInotify.IN_DONT_FOLLOW)
+    DEFAULT_DEBOUNCE = 2.0
+    DEFAULT_MAX_DELAY = 30.0
+
+    def __init__(self, root, db: CPigDb, hash_rows, extensions=None, skip=(),
+                 debounce: float = DEFAULT_DEBOUNCE, max_delay: float = DEFAULT_MAX_DELAY,
+                 batch_size: int = CPigDb.DEFAULT_BATCH_SIZE, resync=None):
+        # hash_rows(entries) turns (Path, fingerprint) entries into
+        # upsert_images rows, resync() rebuilds after lost events
+        self.root = Path(root)
+        self.db = db
+        self.hash_rows = hash_rows
+        self.extensions = {ext.lower() for ext in extensions} if extensions is not None else None
+        self.skip = set(skip)
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        self.resync = resync
+        self.inotify = CInotify()
+        self.dirs = {}  # wd -> relative directory ('' is the root)
+        self.wds = {}   # relative directory -> wd
+        self._reset()
+
+    def _reset(self):
+        self.to_hash = set()
+        self.gone = set()
+        self.gone_dirs = set()
+        self.renames = []       # (old, new, is_dir) in event order
+        self.moved_from = {}    # cookie -> (path, is_dir)
+        self.overflow = False
+        self.first_event = None
+        self.last_event = None
+
+    def close(self) -> None:
+        self.inotify.close()
+
+    def _abs(self, rel_path: str) -> str:
+        return os.path.join(self.root, rel_path) if rel_path else str(self.root)
+
+    def _tracked(self, rel_path: str) -> bool:
+        if rel_path in self.skip:
+            return False
+        return self.extensions is None or os.path.splitext(rel_path)[1].lower() in self.extensions
+
+    def add_tree(self, rel_dir: str = "", b_hash_files: bool = False) -> int:
+        """Watches a directory and all below it, returns the number of new watches.
+
+        With b_hash_files the files found are queued for hashing (for
+        directories created or moved in after the watch started).
+        """
+        count = 0
+        stack = [rel_dir]
+        while stack:
+            directory = stack.pop()
+            try:
+                wd = self.inotify.add_watch(self._abs(directory), self.WATCH_MASK)
+            except OSError as e:
+                print(f"Cannot watch {self._abs(directory)}: {e}")
+                continue
+            self.dirs[wd] = directory
+            self.wds[directory] = wd
+            count += 1
+            try:
+                with os.scandir(self._abs(directory)) as it:
+                    for entry in it:
+                        rel_path = os.path.join(directory, entry.name) if directory else entry.name
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(rel_path)
+                        elif b_hash_files and entry.is_file() and self._tracked(rel_path):
+                            self._hash(rel_path)
+            except OSError as e:
+                print(f"Error reading {self._abs(directory)}: {e}")
+        return count
+
+    def _drop_tree(self, rel_dir: str) -> None:
+        prefix = rel_dir + "/"
+        for directory in [d for d in self.wds if d == rel_dir or d.startswith(prefix)]:
+            wd = self.wds.pop(directory)
+            self.dirs.pop(wd, None)
+            self.inotify.rm_watch(wd)
+
+    @staticmethod
+    def _moved(path: str, old: str, new: str):
+        """path after renaming old to new, None if it is not affected."""
+        if path == old:
+            return new
+        if path.startswith(old + "/"):
+            return new + path[len(old):]
+        return None
+
+    def _hash(self, rel_path: str) -> None:
+        self.gone.discard(rel_path)
+        self.to_hash.add(rel_path)
+
+    def _delete(self, rel_path: str) -> None:
+        self.to_hash.discard(rel_path)
+        self.gone.add(rel_path)
+
+    def _rename(self, old: str, new: str, is_dir: bool) -> None:
+        if is_dir:
+            for directory in [d for d in self.wds if self._moved(d, old, new) is not None]:
+                wd = self.wds.pop(directory)
+                moved = self._moved(directory, old, new)
+                self.wds[moved] = wd
+                self.dirs[wd] = moved
+        elif not self._tracked(old):
+            # e.g. a download renamed from .part to .jpg
+            if self._tracked(new):
+                self._hash(new)
+            return
+        elif not self._tracked(new):
+            self._delete(old)
+            return
+        # pending changes move along with their paths
+        for pending in (self.to_hash, self.gone):
+            for path in [p for p in pending if self._moved(p, old, new) is not None]:
+                pending.discard(path)
+                pending.add(self._moved(path, old, new))
+        self.gone.discard(new)
+        self.renames.append((old, new, is_dir))
+
+    def handle(self, wd: int, mask: int, cookie: int, name: str) -> None:
+        """Applies one inotify event to the pending change set."""
+        if mask & CInotify.IN_Q_OVERFLOW:
+            self.overflow = True
+            return
+        if mask & CInotify.IN_IGNORED:
+            directory = self.dirs.pop(wd, None)
+            if directory is not None and self.wds.get(directory) == wd:
+                del self.wds[directory]
+            return
+        directory = self.dirs.get(wd)
+        if directory is None or not name:
+            return
+        rel_path = os.path.join(directory, name) if directory else name
+        is_dir = bool(mask & CInotify.IN_ISDIR)
+
+        if mask & CInotify.IN_MOVED_FROM:
+            self.moved_from[cookie] = (rel_path, is_dir)
+        elif mask & CInotify.IN_MOVED_TO:
+            source = self.moved_from.pop(cookie, None)
+            if source is not None:
+                self._rename(source[0], rel_path, is_dir)
+            elif is_dir:
+                self.add_tree(rel_path, b_hash_files=True)
+            elif self._tracked(rel_path):
+                self._hash(rel_path)
+        elif is_dir:
+            if mask & CInotify.IN_CREATE:
+                self.add_tree(rel_path, b_hash_files=True)
+        elif mask & (CInotify.IN_CREATE | CInotify.IN_CLOSE_WRITE):
+            if self._tracked(rel_path):
+                self._hash(rel_path)
+        elif mask & CInotify.IN_DELETE:
+            if self._tracked(rel_path):
+                self._delete(rel_path)
+
+    def pending(self) -> bool:
+        return bool(self.to_hash or self.gone or self.gone_dirs or self.renames
+                    or self.moved_from or self.overflow)
+
+    def flush(self) -> None:
+        """Writes the pending changes to the database."""
+        if not self.pending():
+            return
+        if self.overflow:
+            self._reset()
+            if self.resync is None:
+                print("Event queue overflow, changes were lost (run gen_hashes.py --incremental)")
+                return
+            print("Event queue overflow, resynchronizing ...")
+            self.resync()
+            # directories created meanwhile have no watch yet
+            self.add_tree()
+            return
+
+        # moved out of the watched tree
+        for path, is_dir in self.moved_from.values():
+            if is_dir:
+                self._drop_tree(path)
+                self.to_hash = {p for p in self.to_hash if self._moved(p, path, "") is None}
+                self.gone_dirs.add(path)
+            elif self._tracked(path):
+                self._delete(path)
+
+        unknown = self.db.rename_paths(self.renames)
+        for _, new in unknown:
+            self._hash(new)
+        for directory in self.gone_dirs:
+            self.db.mark_missing_under(directory)
+        self.db.mark_missing(sorted(self.gone))
+
+        entries = []
+        for rel_path in sorted(self.to_hash):
+            file_path = self.root / rel_path
+            try:
+                st = os.stat(file_path, follow_symlinks=False)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                entries.append((file_path, (st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev)))
+        count = self.db.upsert_images(self.hash_rows(entries), batch_size=self.batch_size)
+
+        print(f"{time.strftime('%H:%M:%S')} {count} hashed, {len(self.renames)} moved, "
+              f"{len(self.gone) + len(self.gone_dirs)} gone")
+        self._reset()
+
+    def run(self) -> None:
+        """Reads events until interrupted, flushing after each quiet period."""
+        while True:
+            timeout = None
+            if self.pending():
+                now = time.monotonic()
+                timeout = max(0.0, min(self.last_event + self.debounce,
+                                       self.first_event + self.max_delay) - now)
+            events = self.inotify.read(timeout)
+            now = time.monotonic()
+            if events:
+                if self.first_event is None:
+                    self.first_event = now
+                self.last_event = now
+                for event in events:
+                    self.handle(*event)
+            if not self.pending():
+                self.first_event = None
+            elif now - self.last_event >= self.debounce or now - self.first_event >= self.max_delay:
+                self.flush()
@@ -0,0 +1,381 @@
+#!/usr/bin/python3
+
+##############################################################################
+# Benchmark suite for the hot paths of gen_hashes and CPigDb.
+#
+#   generate  builds a reproducible synthetic photo tree (seeded): JPEG and
+#             PNG images of several sizes, byte-identical duplicates,
+#             re-encoded/resized near duplicates and non-image files
+#   run       times every stage on such a tree and writes the results as
+#             JSON (generates the tree first if it does not exist)
+#   startup   times the start of the command line tools (one process per
+#             call, like scripts calling them in a loop)
+#   compare   prints the per-stage ratio of two result files, e.g. of two
+#             commits
+#
+# Example:
+#   ./benchmark.py run /tmp/bench10k --files 10000 --output before.json
+#   ./benchmark.py startup /tmp/bench10k --output startup.json
+#   ./benchmark.py compare before.json after.json
+##############################################################################
+
+import argparse
+import compileall
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from PIL import Image, ImageDraw
+
+from CPigDb import CPigDb
+from config import Config
+from gen_hashes import gen_hashes, gen_hashes_fast, walk_files
+
+MANIFEST_FILE = "manifest.json"
+TREE_DIR = "tree"
+
+# presets for --scale
+SCALES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+
+# image sizes of the synthetic photos (width, height) with their weights
+DEFAULT_IMAGE_SIZES = "160x120:5,640x480:3,1600x1200:1"
+
+# main function
+def main():
+    args = parse_args()
+    if args.command == "generate":
+        generate_tree(Path(args.directory), generator_params(args))
+    elif args.command == "run":
+        results = run_benchmark(Path(args.directory), generator_params(args), args.jobs,
+                                args.stages)
+        write_results(results, args.output)
+    elif args.command == "startup":
+        write_results(run_startup(Path(args.directory), args.runs), args.output)
+    elif args.command == "compare":
+        compare_results(args.before, args.after)
+
+# Arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks for the photo tools hot paths.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    tree_args = argparse.ArgumentParser(add_help=False)
+    tree_args.add_argument("directory", type=str, help="Benchmark directory (tree + databases)")
+    tree_args.add_argument("--files", type=int, default=1000, help="Number of files (default: 1000)")
+    tree_args.add_argument("--scale", choices=SCALES, help="Preset for --files (10k, 100k, 1m)")
+    tree_args.add_argument("--dup-ratio", type=float, default=0.1,
+                           help="Share of byte-identical copies (default: 0.1)")
+    tree_args.add_argument("--near-dup-ratio", type=float, default=0.05,
+                           help="Share of re-encoded/resized copies (default: 0.05)")
+    tree_args.add_argument("--non-image-ratio", type=float, default=0.1,
+                           help="Share of non-image files (default: 0.1)")
+    tree_args.add_argument("--image-sizes", type=str, default=DEFAULT_IMAGE_SIZES,
+                           help=f"WxH:weight,... (default: {DEFAULT_IMAGE_SIZES})")
+    tree_args.add_argument("--files-per-dir", type=int, default=500,
+                           help="Files per directory (default: 500)")
+    tree_args.add_argument("--seed", type=int, default=1, help="Random seed (default: 1)")
+
+    commands.add_parser("generate", parents=[tree_args], help="Generate a synthetic photo tree")
+
+    run = commands.add_parser("run", parents=[tree_args], help="Time all stages")
+    run.add_argument("-j", "--jobs", type=int, default=1, help="Hashing processes (default: 1)")
+    run.add_argument("--stages", nargs="*", default=None, choices=list(STAGES), metavar="STAGE",
+                     help=f"Stages to run (default: all of {', '.join(STAGES)})")
+    run.add_argument("-o", "--output", type=str, default=None,
+                     help="JSON result file (default: stdout)")
+
+    startup = commands.add_parser("startup", help="Time the start of the command line tools")
+    startup.add_argument("directory", type=str, help="Benchmark directory (database + config)")
+    startup.add_argument("--runs", type=int, default=20,
+                         help="Calls per command, the median is reported (default: 20)")
+    startup.add_argument("-o", "--output", type=str, default=None,
+                         help="JSON result file (default: stdout)")
+
+    compare = commands.add_parser("compare", help="Compare two result files")
+    compare.add_argument("before", type=str)
+    compare.add_argument("after", type=str)
+
+    return parser.parse_args()
+
+def generator_params(args) -> dict:
+    sizes = []
+    for item in args.image_sizes.split(","):
+        size, _, weight = item.partition(":")
+        width, height = size.lower().split("x")
+        sizes.append([int(width), int(height), float(weight or 1)])
+    return {
+        "files": SCALES[args.scale] if args.scale else args.files,
+        "dup_ratio": args.dup_ratio,
+        "near_dup_ratio": args.near_dup_ratio,
+        "non_image_ratio": args.non_image_ratio,
+        "image_sizes": sizes,
+        "files_per_dir": args.files_per_dir,
+        "seed": args.seed,
+    }
+
+# synthetic photo with gradient background and random shapes
+def make_image(rnd, width, height):
+    image = Image.linear_gradient("L").resize((width, height)).rotate(rnd.randrange(360))
+    tint = tuple(rnd.randrange(256) for _ in range(3))
+    image = Image.merge("RGB", (image, image.point(lambda v: (v + tint[1]) % 256),
+                                Image.new("L", (width, height), tint[2])))
+    draw = ImageDraw.Draw(image)
+    for _ in range(rnd.randint(4, 12)):
+        x0, y0 = rnd.randrange(width), rnd.randrange(height)
+        x1, y1 = x0 + rnd.randrange(width // 2 + 1), y0 + rnd.randrange(height // 2 + 1)
+        color = tuple(rnd.randrange(256) for _ in range(3))
+        if rnd.random() < 0.5:
+            draw.rectangle((x0, y0, x1, y1), fill=color)
+        else:
+            draw.ellipse((x0, y0, x1, y1), fill=color)
+    return image
+
+# reproducible synthetic tree under directory/tree, returns the manifest
+def generate_tree(directory, params):
+    tree = directory / TREE_DIR
+    manifest_path = directory / MANIFEST_FILE
+    if manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text())
+        if manifest["params"] == params:
+            print(f"Using existing tree {tree}")
+            return manifest
+        raise SystemExit(f"Error: {directory} holds a tree generated with other parameters")
+
+    rnd = random.Random(params["seed"])
+    sizes = [(w, h) for w, h, _ in params["image_sizes"]]
+    weights = [weight for _, _, weight in params["image_sizes"]]
+    originals = []
+    counts = {"images": 0, "duplicates": 0, "near_duplicates": 0, "non_images": 0}
+    total_bytes = 0
+
+    for index in range(params["files"]):
+        folder = tree / f"{index // params['files_per_dir']:05d}"
+        if index % params["files_per_dir"] == 0:
+            folder.mkdir(parents=True, exist_ok=True)
+        kind = rnd.random()
+        if kind < params["non_image_ratio"]:
+            # lognormal sizes around a few KiB, a few large ones
+            path = folder / f"file{index:07d}.bin"
+            path.write_bytes(rnd.randbytes(min(int(rnd.lognormvariate(8.5, 1.5)), 64 << 20)))
+            counts["non_images"] += 1
+        elif originals and kind < params["non_image_ratio"] + params["dup_ratio"]:
+            source = rnd.choice(originals)
+            path = folder / f"dup{index:07d}{source.suffix}"
+            path.write_bytes(source.read_bytes())
+            counts["duplicates"] += 1
+        elif originals and kind < (params["non_image_ratio"] + params["dup_ratio"]
+                                   + params["near_dup_ratio"]):
+            source = rnd.choice(originals)
+            path = folder / f"near{index:07d}.jpg"
+            with Image.open(source) as image:
+                image = image.convert("RGB")
+                scale = rnd.choice((1.0, 0.75, 0.5))
+                image = image.resize((max(1, int(image.width * scale)),
+                                      max(1, int(image.height * scale))))
+                image.save(path, quality=rnd.randint(60, 90))
+            counts["near_duplicates"] += 1
+        else:
+            width, height = rnd.choices(sizes, weights)[0]
+            image = make_image(rnd, width, height)
+            if rnd.random() < 0.8:
+                path = folder / f"img{index:07d}.jpg"
+                image.save(path, quality=rnd.randint(75, 95))
+            else:
+                path = folder / f"img{index:07d}.png"
+                image.save(path)
+            originals.append(path)
+            counts["images"] += 1
+        total_bytes += path.stat().st_size
+        if index % 100 == 0:
+            print(f"Generating: {index}/{params['files']}", end="\r")
+
+    manifest = {"params": params, "counts": counts, "bytes": total_bytes}
+    manifest_path.write_text(json.dumps(manifest, indent=4))
+    print(f"\nGenerated {params['files']} files ({total_bytes} bytes) in {tree}")
+    return manifest
+
+# stages: name -> function(context) returning the number of processed items
+def stage_walk(ctx):
+    return sum(1 for _ in walk_files(ctx["tree"]))
+
+def stage_gen_hashes(ctx):
+    gen_hashes(ctx["tree"], hash_file=ctx["db"], jobs=ctx["jobs"])
+    return ctx["files"]
+
+def stage_gen_hashes_incremental(ctx):
+    gen_hashes(ctx["tree"], hash_file=ctx["db"], jobs=ctx["jobs"], incremental=True)
+    return ctx["files"]
+
+def stage_gen_hashes_fast(ctx):
+    gen_hashes_fast(ctx["tree"], hash_file=ctx["db_fast"], jobs=ctx["jobs"])
+    return ctx["files"]
+
+def stage_find_doubles(ctx):
+    return sum(1 for _ in CPigDb(ctx["db"]).find_doubles_by_md5())
+
+def stage_count_doubles(ctx):
+    return CPigDb(ctx["db"]).count_doubles_by_md5()
+
+def stage_get_stats(ctx):
+    return CPigDb(ctx["db"]).get_stats()["total_images"]
+
+def stage_check_unregistered(ctx):
+    db = CPigDb(ctx["db"])
+    # the stored paths are relative to the tree, not to the database directory
+    db.check_unregistered_files(str(ctx["tree"]))
+    return len(db.get_unregistered_files())
+
+def stage_find_similar(ctx):
+    return len(CPigDb(ctx["db"]).find_similar_by_phash())
+
+def stage_find_phash_clusters(ctx):
+    return len(CPigDb(ctx["db"]).find_phash_clusters())
+
+STAGES = {
+    "walk": stage_walk,
+    "gen_hashes": stage_gen_hashes,
+    "gen_hashes_incremental": stage_gen_hashes_incremental,
+    "gen_hashes_fast": stage_gen_hashes_fast,
+    "find_doubles_by_md5": stage_find_doubles,
+    "count_doubles_by_md5": stage_count_doubles,
+    "get_stats": stage_get_stats,
+    "check_unregistered_files": stage_check_unregistered,
+    "find_similar_by_phash": stage_find_similar,
+    "find_phash_clusters": stage_find_phash_clusters,
+}
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# run the stages on a (generated) tree, returns the result dict
+def run_benchmark(directory, params, jobs=1, stages=None):
+    manifest = generate_tree(directory, params)
+    ctx = {
+        "tree": (directory / TREE_DIR).resolve(),
+        "db": str(directory / "bench.db"),
+        "db_fast": str(directory / "bench_fast.db"),
+        "files": params["files"],
+        "jobs": jobs,
+    }
+    # every run starts with empty databases
+    for name in ("bench.db", "bench_fast.db"):
+        for suffix in ("", "-wal", "-shm"):
+            path = directory / (name + suffix)
+            if path.exists():
+                path.unlink()
+
+    results = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "jobs": jobs,
+        "manifest": manifest,
+        "stages": {},
+    }
+    for name in stages or STAGES:
+        start = time.perf_counter()
+        # the progress output would only measure the terminal
+        with contextlib.redirect_stdout(io.StringIO()):
+            items = STAGES[name](ctx)
+        seconds = time.perf_counter() - start
+        results["stages"][name] = {
+            "seconds": round(seconds, 4),
+            "items": items,
+            "files_per_s": round(params["files"] / seconds, 1) if seconds else None,
+        }
+        print(f"{name}: {seconds:.3f} s", file=sys.stderr)
+    return results
+
+# command lines for the startup benchmark: name -> arguments after python
+def startup_commands(config_file):
+    script_dir = Path(__file__).resolve().parent
+    return {
+        "python": ["-c", "pass"],
+        "consistence_check_get_stats": [str(script_dir / "consistence-check.py"),
+                                        "--config", config_file, "--get-stats"],
+        "gen_hashes_help": [str(script_dir / "gen_hashes.py"), "--help"],
+        "index_lookup_help": [str(script_dir / "index_lookup.py"), "--help"],
+    }
+
+# median wall time of every startup command over runs processes, the bare
+# interpreter start ("python") is the lower bound
+def run_startup(directory, runs=20):
+    directory.mkdir(parents=True, exist_ok=True)
+    db_file = directory / "startup.db"
+    if not db_file.exists():
+        db = CPigDb(str(db_file))
+        db.create_database()
+        db.close()
+    config_file = directory / "startup_config.json"
+    config_file.write_text(json.dumps({
+        Config.KEY_DB_PATH: str(db_file.resolve()),
+        Config.KEY_IMAGE_EXTENSIONS: Config.VAL_DEFAULT_IMAGE_EXTENSIONS,
+    }, indent=4))
+    # like an installed tool: modules compiled, not the compile time measured
+    compileall.compile_dir(str(Path(__file__).resolve().parent), quiet=1)
+
+    results = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "runs": runs,
+        "stages": {},
+    }
+    for name, arguments in startup_commands(str(config_file)).items():
+        times = []
+        # one call more, the first one warms the page cache
+        for _ in range(runs + 1):
+            start = time.perf_counter()
+            subprocess.run([sys.executable] + arguments, cwd=directory, check=True,
+                           stdout=subprocess.DEVNULL)
+            times.append(time.perf_counter() - start)
+        seconds = statistics.median(times[1:])
+        results["stages"][name] = {
+            "seconds": round(seconds, 4),
+            "min_seconds": round(min(times[1:]), 4),
+            "items": runs,
+        }
+        print(f"{name}: {seconds * 1000:.1f} ms", file=sys.stderr)
+    return results
+
+def write_results(results, output=None):
+    text = json.dumps(results, indent=4)
+    if output is None:
+        print(text)
+    else:
+        Path(output).write_text(text)
+        print(f"Results saved to: {output}", file=sys.stderr)
+
+# per stage time ratio after/before (< 1 is faster)
+def compare_results(before_file, after_file):
+    before = json.loads(Path(before_file).read_text())
+    after = json.loads(Path(after_file).read_text())
+    if "manifest" in before and before["manifest"]["params"] != after["manifest"]["params"]:
+        print("Warning: the results were measured on different trees")
+    print(f"{'stage':28} {'before':>10} {'after':>10} {'ratio':>7}")
+    for name, stage in after["stages"].items():
+        old = before["stages"].get(name)
+        if old is None:
+            print(f"{name:28} {'-':>10} {stage['seconds']:>10.3f} {'-':>7}")
+            continue
+        ratio = stage["seconds"] / old["seconds"] if old["seconds"] else float("inf")
+        print(f"{name:28} {old['seconds']:>10.3f} {stage['seconds']:>10.3f} {ratio:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
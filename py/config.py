@@ -11,7 +11,6 @@
 
 import json
 import os
-import argparse
 from typing import Optional
 
 # Singleton metaclass for Config
@@ -28,9 +27,19 @@ class _SingletonMeta(type):
 class Config(metaclass=_SingletonMeta):
     KEY_DB_PATH = "db_path"
     KEY_IMAGE_EXTENSIONS = "image_extensions"
+    KEY_PHASH_DECODE_SCALE = "phash_decode_scale"
+    KEY_HASH_ALGORITHM = "hash_algorithm"
     VAL_DEFAULT_CONFIG_PATH = "./.cpig_config.json"
     VAL_DEFAULT_DB_PATH = "./cpig_database.db"
     VAL_DEFAULT_IMAGE_EXTENSIONS = [".jpg", ".jpeg", ".png", ".bmp", ".gif"]
+    # JPEG decode scale for the perceptual hash (1 = full decode, 2, 4 or 8)
+    VAL_DEFAULT_PHASH_DECODE_SCALE = 1
+    VAL_PHASH_DECODE_SCALES = (1, 2, 4, 8)
+    # content hash for exact duplicates (see content_hash.py), md5 for
+    # compatibility; all known names are valid here, xxh128 is only
+    # available at run time with the xxhash package (checked by the scripts)
+    VAL_DEFAULT_HASH_ALGORITHM = "md5"
+    VAL_HASH_ALGORITHMS = ("md5", "blake2b", "sha256", "xxh128")
         
     """Configuration holder (singleton).
 
@@ -54,9 +63,13 @@ class Config(metaclass=_SingletonMeta):
         self.path_to_cfg = self.VAL_DEFAULT_CONFIG_PATH
         self.db_path = self.VAL_DEFAULT_DB_PATH
         self.image_extensions = self.VAL_DEFAULT_IMAGE_EXTENSIONS
+        self.phash_decode_scale = self.VAL_DEFAULT_PHASH_DECODE_SCALE
+        self.hash_algorithm = self.VAL_DEFAULT_HASH_ALGORITHM
         self.settings = {
             "db_path": self.db_path,
             "image_extensions": self.image_extensions,
+            "phash_decode_scale": self.phash_decode_scale,
+            "hash_algorithm": self.hash_algorithm,
         }
 
     def save_config(self) -> None:
@@ -89,6 +102,11 @@ class Config(metaclass=_SingletonMeta):
 
         self.db_path = self.settings.get("db_path", None)
         self.image_extensions = self.settings.get("image_extensions", [])
+        # optional, older config files do not have it
+        self.phash_decode_scale = self.settings.get(
+            "phash_decode_scale", self.VAL_DEFAULT_PHASH_DECODE_SCALE)
+        self.hash_algorithm = self.settings.get(
+            "hash_algorithm", self.VAL_DEFAULT_HASH_ALGORITHM)
 
         return True
 
@@ -101,18 +119,28 @@ class Config(metaclass=_SingletonMeta):
             return False
         if self.settings.get("image_extensions", None) is None:
             return False
+        if self.settings.get("phash_decode_scale", self.VAL_DEFAULT_PHASH_DECODE_SCALE) \
+                not in self.VAL_PHASH_DECODE_SCALES:
+            return False
+        if self.settings.get("hash_algorithm", self.VAL_DEFAULT_HASH_ALGORITHM) \
+                not in self.VAL_HASH_ALGORITHMS:
+            return False
         return True
 
     def __update_setting__(self) -> None:
         """Update a configuration setting and reflect it in the settings dict."""
         self.settings[self.KEY_DB_PATH] = self.db_path
         self.settings[self.KEY_IMAGE_EXTENSIONS] = self.image_extensions
+        self.settings[self.KEY_PHASH_DECODE_SCALE] = self.phash_decode_scale
+        self.settings[self.KEY_HASH_ALGORITHM] = self.hash_algorithm
                 
     def print_config(self) -> None:
         """Print current configuration to console."""
         print (f"path_to_cfg: {self.path_to_cfg}")
         print (f"db_path: {self.db_path}")
         print (f"image_extensions: {self.image_extensions}")
+        print (f"phash_decode_scale: {self.phash_decode_scale}")
+        print (f"hash_algorithm: {self.hash_algorithm}")
 
     # Getter Methods
     def get_db_path(self) -> str:
@@ -123,6 +151,14 @@ class Config(metaclass=_SingletonMeta):
         '''return the list of image extensions from the configuration'''
         return self.image_extensions
 
+    def get_phash_decode_scale(self) -> int:
+        '''return the JPEG decode scale used for the perceptual hash'''
+        return self.phash_decode_scale
+
+    def get_hash_algorithm(self) -> str:
+        '''return the content hash algorithm for exact duplicates'''
+        return self.hash_algorithm
+
 # Script entry point
 
 def main():
@@ -144,6 +180,7 @@ def main():
         config.print_config()
             
 def get_args():
+    import argparse
     parser = argparse.ArgumentParser(description="Photo Tools Configuration")
     parser.add_argument('--config', type=str, help='Path to configuration file')
     parser.add_argument('--make_default', action='store_true', help='Create default configuration file')
@@ -1,9 +1,24 @@
 #!/usr/bin/env python3
 import argparse
-import argcomplete
+import os
 
 from CPigDb import CPigDb
 from config import Config
+import dedupe
+
+# CPigDb methods timed with --profile
+PROFILED_METHODS = [
+    "check_files",
+    "get_stats",
+    "count_doubles_by_md5",
+    "find_doubles_by_md5",
+    "find_similar_by_phash",
+    "build_phash_index",
+    "find_phash_clusters",
+    "find_doubles_across_archives",
+    "delete_file_entry",
+    "delete_entries",
+]
 
 def main():
     args = parse_args()
@@ -30,12 +45,26 @@ def main():
             print(f"Database {config.get_db_path()} already exists.")
         exit(0)
         
-    db = CPigDb(config.get_db_path())
+    profiler = None
+    if args.profile or args.profile_interval:
+        from CProfiler import CProfiler
+        profiler = CProfiler(interval=args.profile_interval)
+        with profiler.timed("open_db"):
+            db = CPigDb(config.get_db_path())
+        profiler.instrument(db, PROFILED_METHODS)
+    else:
+        db = CPigDb(config.get_db_path())
     if db.get_error() != db.ERROR_STAT_NONE:
         print(f"Error opening database: {db.get_error()}")
         return
+    db.root = args.root
+    for archive in args.archive or []:
+        if not db.attach_archive(*archive):
+            return
+    b_archives = bool(db.archives)
     
-    if consistency_check(db) is False:
+    b_check_files = args.get_unregistered_files or args.get_lost_files
+    if consistency_check(db, b_check_files, args.root, args.threads) is False:
         print("Database consistency check failed.")
     else:
         print("Database is consistent.")
@@ -45,12 +74,29 @@ def main():
     
     if args.get_unregistered_files:
         get_unregistered_files(db, b_verbose=args.verbose)
+
+    if args.get_lost_files:
+        get_lost_files(db, b_verbose=args.verbose)
     
-    if args.check_doubles:
+    if args.check_doubles and b_archives:
+        get_archive_double_files(db, args.cross_only, b_verbose=args.verbose)
+    elif args.check_doubles:
         get_double_files(db, b_verbose=args.verbose)
         
-    if args.delete_doubles:
-        delete_double_files(db, b_verbose=args.verbose)
+    if args.check_similar:
+        get_similar_files(db, args.max_distance, b_verbose=args.verbose, b_archives=b_archives)
+
+    if args.cluster_similar:
+        get_similar_clusters(db, args.max_distance, b_verbose=args.verbose, b_archives=b_archives)
+
+    if args.delete_doubles or args.apply_plan:
+        delete_double_files(db, b_verbose=args.verbose, keep_policy=args.keep_policy,
+                            plan_file=args.plan_file, plan_format=args.plan_format,
+                            b_apply=args.apply, apply_plan=args.apply_plan,
+                            root=args.root, threads=args.threads)
+
+    if args.profile:
+        profiler.write_json(args.profile)
 
 
 def parse_args():
@@ -59,20 +105,58 @@ def parse_args():
     parser.add_argument("-v", "--verbose", action="store_true", help="verbose")
     parser.add_argument("--get-stats", action="store_true", help="Get database statistics.")
     parser.add_argument("--get-unregistered-files", action="store_true", help="Get unregistered files.") 
+    parser.add_argument("--get-lost-files", action="store_true", help="Get lost and changed files.")
+    parser.add_argument("--root", default=None,
+                        help="Root of the stored paths for the file checks (default: directory of the database)")
+    parser.add_argument("--threads", type=int, default=None, help="Threads for stat calls in the file checks")
     parser.add_argument("--check-doubles", action="store_true", help="Check for doubles") 
+    parser.add_argument("--check-similar", action="store_true", help="Check for similar images (pHash)")
+    parser.add_argument("--max-distance", type=int, default=CPigDb.DEFAULT_PHASH_DISTANCE,
+                        help=f"Max. pHash bit distance for --check-similar and --cluster-similar (default: {CPigDb.DEFAULT_PHASH_DISTANCE})")
+    parser.add_argument("--cluster-similar", action="store_true",
+                        help="Group all similar images into clusters (pHash, needs numpy)")
+    parser.add_argument("--archive", action="append", nargs="+", metavar=("DB", "ROOT"),
+                        help="Attach the database of another archive (optional ROOT of its paths, "
+                             "default: its directory); doubles and similar images are searched across all")
+    parser.add_argument("--cross-only", action="store_true",
+                        help="With --archive only report md5 doubles found in more than one archive")
     parser.add_argument("--delete-doubles", action="store_true", help="Generate a delete script for doubles") 
+    parser.add_argument("--keep-policy", choices=dedupe.KEEP_POLICIES, default=dedupe.DEFAULT_KEEP_POLICY,
+                        help=f"File kept per group for --delete-doubles (default: {dedupe.DEFAULT_KEEP_POLICY})")
+    parser.add_argument("--plan-format", choices=dedupe.PLAN_FORMATS, default="shell",
+                        help="Format of the delete plan (default: shell)")
+    parser.add_argument("--plan-file", default=None,
+                        help="Delete plan file (default: delete_doubles.sh or delete_doubles.json)")
+    parser.add_argument("--apply", action="store_true",
+                        help="Delete the files of the plan and their database entries right away")
+    parser.add_argument("--apply-plan", metavar="PLAN_JSON", default=None,
+                        help="Apply a JSON delete plan written before")
     parser.add_argument("--info", action="store_true", help="Print info messages.")
     parser.add_argument('--config', default=Config.VAL_DEFAULT_CONFIG_PATH, type=str, help='Path to configuration file')
     parser.add_argument('--create-db', action="store_true", help='Create default database if not exists')
+    parser.add_argument("--profile", nargs="?", const="profile.json", default=None,
+                        help="Write the time of the database queries as JSON (default: profile.json)")
+    parser.add_argument("--profile-interval", type=float, default=0.0,
+                        help="Print profile stats every N seconds while running")
     
-    argcomplete.autocomplete(parser)
-    return parser.parse_args()
+    # argcomplete is only needed when the shell asks for completions
+    if "_ARGCOMPLETE" in os.environ:
+        import argcomplete
+        argcomplete.autocomplete(parser)
+    args = parser.parse_args()
+    for archive in args.archive or []:
+        if len(archive) > 2:
+            parser.error("--archive takes a database and an optional root")
+    return args
 
-def consistency_check(db:CPigDb) -> bool:
+def consistency_check(db:CPigDb, b_check_files:bool = False, root:str = None,
+                      threads:int = None) -> bool:
     if db.get_error() != db.ERROR_STAT_NONE:
         print(f"Error opening database: {db.get_error()}")
         return False
-    db.check_unregistered_files()    
+    # the recursive file check walks the whole tree, only on request
+    if b_check_files:
+        return db.check_files(root, threads)
     return True
 
 def get_stats(db:CPigDb, b_info:bool = True, b_verbose:bool = False):
@@ -107,44 +191,118 @@ def get_unregistered_files(db:CPigDb, b_info = True, b_verbose = False):
             print("No unregistered files found.")
     return unregistered_files
 
-def get_double_files(db:CPigDb, b_info= True, b_verbose = False):
-    double_files = db.find_doubles_by_md5()
-    if not double_files:
+def get_lost_files(db:CPigDb, b_info = True, b_verbose = False):
+    lost_files = db.get_lost_files()
+    changed_files = db.get_changed_files()
+    if b_info:
+        print(f"{len(lost_files)} lost files found.")
+        print(f"{len(changed_files)} changed files found.")
+
+    if b_verbose:
+        for file in lost_files:
+            print(f" - lost: {file}")
+        for file in changed_files:
+            print(f" - changed: {file}")
+    return lost_files
+
+def get_double_files(db:CPigDb, b_info= True, b_verbose = False) -> int:
+    # counting is cheap, the groups are only streamed for the verbose output
+    count_double_files = db.count_doubles_by_md5()
+    if not count_double_files:
         if b_info:
             print("No double files found.")
-        return []
+        return 0
     
     if b_info:
-        print (f"{len(double_files)} double files found.")
+        print (f"{count_double_files} double files found.")
     
     if b_verbose:
-        for file in double_files:
+        for file in db.find_doubles_by_md5():
             print(f"{file}")
             
-    return double_files
+    return count_double_files
+
+def get_archive_double_files(db:CPigDb, b_cross_only:bool = False, b_info= True, b_verbose = False) -> int:
+    count_double_files = 0
+    for md5, paths in db.find_doubles_across_archives(b_cross_only):
+        count_double_files += 1
+        if b_verbose:
+            print(f"{(md5, paths)}")
+
+    if b_info:
+        archives = len(db.get_archives())
+        if count_double_files:
+            print (f"{count_double_files} double files found in {archives} archives.")
+        else:
+            print(f"No double files found in {archives} archives.")
+    return count_double_files
 
-def delete_double_files(db:CPigDb, b_info= True, b_verbose = False):
-    double_files = db.find_doubles_by_md5()
-    if not double_files:
+def get_similar_files(db:CPigDb, max_distance:int, b_info= True, b_verbose = False,
+                      b_archives:bool = False):
+    similar_files = db.find_similar_by_phash(max_distance, b_archives)
+    if not similar_files:
         if b_info:
-            print("No double files found.")
+            print("No similar files found.")
         return []
-    
-    count_double_files = len(double_files)
+
     if b_info:
-        print (f"{count_double_files} double files found.")
-    
-    deleted_files = 0
-    for file_found in double_files:
-        md5 = file_found[0]
-        file_to_delete = file_found[1][0]
-        for double_file in file_found[1]:
-            if len(double_file) > len(file_to_delete):
-                file_to_delete = double_file
-        if b_verbose:
-            deleted_files += 1
-            print (f"Delete file({deleted_files}/{count_double_files}): {file_to_delete} with md5: {md5}")
-            db.delete_file_entry(md5,double_file)
-            
+        print (f"{len(similar_files)} similar file groups found.")
+
+    if b_verbose:
+        for group in similar_files:
+            print(f"{group}")
+
+    return similar_files
+
+def get_similar_clusters(db:CPigDb, max_distance:int, b_info= True, b_verbose = False,
+                         b_archives:bool = False):
+    clusters = db.find_phash_clusters(max_distance, b_archives=b_archives)
+    if not clusters:
+        if b_info:
+            print("No similar file clusters found.")
+        return []
+
+    if b_info:
+        print (f"{len(clusters)} similar file clusters with "
+               f"{sum(len(paths) for _, paths in clusters)} files found.")
+
+    if b_verbose:
+        for cluster in clusters:
+            print(f"{cluster}")
+
+    return clusters
+
+def delete_double_files(db:CPigDb, b_info= True, b_verbose = False,
+                        keep_policy:str = dedupe.DEFAULT_KEEP_POLICY, plan_file:str = None,
+                        plan_format:str = "shell", b_apply:bool = False, apply_plan:str = None,
+                        root:str = None, threads:int = None):
+    threads = threads or dedupe.DEFAULT_THREADS
+    if apply_plan:
+        root, plan = dedupe.read_plan(apply_plan)
+    else:
+        count_double_files = db.count_doubles_by_md5()
+        if not count_double_files:
+            if b_info:
+                print("No double files found.")
+            return 0
+
+        if b_info:
+            print (f"{count_double_files} double files found.")
+
+        root = root or db.get_root()
+        plan_file = plan_file or f"delete_doubles.{'sh' if plan_format == 'shell' else 'json'}"
+        count = dedupe.write_plan(dedupe.make_delete_plan(db, keep_policy), plan_file,
+                                  plan_format, root)
+        if b_info:
+            print(f"Delete plan for {count} files saved to: {plan_file}")
+        if not b_apply:
+            return count
+        plan = dedupe.make_delete_plan(db, keep_policy)
+
+    deleted, failed = dedupe.apply_plan(db, plan, root, threads, b_verbose)
+    if b_info:
+        print(f"{deleted} files deleted, {failed} failed.")
+    return deleted
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,66 @@
+##############################################################################
+# Content hash algorithms for the exact duplicate detection.
+#
+# The content hash is stored in the md5_hash column of CPigDb, with its
+# algorithm per row (hash_algorithm), so every algorithm here produces a
+# 16 byte digest: the column, the md5 index and the fixed width records of
+# CHashIndex stay the same whatever is selected.
+#   md5      - the default, compatible with existing databases and md5sum
+#   blake2b  - BLAKE2b with 16 byte digest, somewhat faster than md5 in software
+#   sha256   - SHA-256 truncated to 16 bytes; with the SHA extensions of
+#              current x86/ARM CPUs about twice as fast as md5
+#   xxh128   - XXH3 128 bit, non-cryptographic and far faster than the disk;
+#              only with the optional xxhash package installed
+##############################################################################
+
+import functools
+import hashlib
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+DEFAULT_ALGORITHM = "md5"
+DIGEST_SIZE = 16
+
+
+class _Truncated:
+    """hashlib object whose digest is cut to DIGEST_SIZE bytes."""
+
+    def __init__(self, hasher):
+        self.hasher = hasher
+
+    def update(self, data) -> None:
+        self.hasher.update(data)
+
+    def digest(self) -> bytes:
+        return self.hasher.digest()[:DIGEST_SIZE]
+
+    def hexdigest(self) -> str:
+        return self.digest().hex()
+
+
+HASH_ALGORITHMS = {
+    "md5": hashlib.md5,
+    "blake2b": functools.partial(hashlib.blake2b, digest_size=DIGEST_SIZE),
+    "sha256": lambda: _Truncated(hashlib.sha256()),
+}
+if xxhash is not None:
+    HASH_ALGORITHMS["xxh128"] = xxhash.xxh3_128
+
+
+def new_hash(algorithm: str = DEFAULT_ALGORITHM):
+    '''new hashlib-like object of the algorithm'''
+    try:
+        return HASH_ALGORITHMS[algorithm]()
+    except KeyError:
+        raise ValueError(f"Hash algorithm {algorithm} is not available "
+                         f"(available: {', '.join(HASH_ALGORITHMS)})") from None
+
+
+def hash_bytes(data, algorithm: str = DEFAULT_ALGORITHM) -> str:
+    '''hex digest of a bytes-like object'''
+    hasher = new_hash(algorithm)
+    hasher.update(data)
+    return hasher.hexdigest()
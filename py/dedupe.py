@@ -0,0 +1,130 @@
+##############################################################################
+# Delete plans for byte-identical duplicates (find_doubles_by_md5).
+#
+# A plan keeps one file per md5 group, chosen by a keep policy, and lists
+# the others for deletion. It is written as shell script (for review and
+# manual use) or as JSON. Applying a plan first compares every file of a
+# group with the size and mtime stored when it was hashed and skips the
+# group if one of them changed (or the kept file is gone), then unlinks
+# the files from a thread pool and removes the rows of all deleted files
+# in one transaction.
+##############################################################################
+
+import json
+import os
+import shlex
+
+from CPigDb import CPigDb
+
+# keep policies: which path of a duplicate group stays
+KEEP_POLICIES = {
+    "shortest-path": lambda paths: min(paths, key=lambda path: (len(path), path)),
+    "longest-path": lambda paths: max(paths, key=lambda path: (len(path), path)),
+    "first": lambda paths: paths[0],
+    "last": lambda paths: paths[-1],
+}
+DEFAULT_KEEP_POLICY = "shortest-path"
+
+PLAN_FORMATS = ("shell", "json")
+DEFAULT_THREADS = 16
+
+# streamed plan entries (md5, keep, [delete])
+def make_delete_plan(db: CPigDb, policy: str = DEFAULT_KEEP_POLICY):
+    choose = KEEP_POLICIES[policy]
+    for md5, paths in db.find_doubles_by_md5():
+        keep = choose(paths)
+        yield md5, keep, [path for path in paths if path != keep]
+
+# write the plan, returns the number of files to delete
+def write_plan(plan, file_name: str, plan_format: str, root: str) -> int:
+    count = 0
+    with open(file_name, "w") as plan_file:
+        if plan_format == "shell":
+            plan_file.write("#!/bin/sh\n")
+            plan_file.write("# delete plan for duplicate files, generated by consistence-check.py\n")
+            plan_file.write("# the database is not updated by this script, run\n")
+            plan_file.write("# gen_hashes.py --incremental afterwards to mark the files missing\n")
+            for md5, keep, delete in plan:
+                # no paths in comments: a newline in a name would end the
+                # comment, so the kept file is the argument of a no-op
+                plan_file.write(f"\n# {md5}\n: keep {shlex.quote(os.path.join(root, keep))}\n")
+                for path in delete:
+                    plan_file.write(f"rm -f -- {shlex.quote(os.path.join(root, path))}\n")
+                    count += 1
+        else:
+            # one group per line, so large plans are written as a stream
+            plan_file.write(f'{{"root": {json.dumps(root)}, "groups": [\n')
+            first = True
+            for md5, keep, delete in plan:
+                if not first:
+                    plan_file.write(",\n")
+                first = False
+                plan_file.write(json.dumps({"md5": md5, "keep": keep, "delete": delete}))
+                count += len(delete)
+            plan_file.write("\n]}\n")
+    if plan_format == "shell":
+        os.chmod(file_name, 0o755)
+    return count
+
+def read_plan(file_name: str):
+    with open(file_name) as plan_file:
+        plan = json.load(plan_file)
+    return plan["root"], [(g["md5"], g["keep"], g["delete"]) for g in plan["groups"]]
+
+# unlink one file, True if it is gone afterwards
+def unlink_file(file_path: str) -> bool:
+    try:
+        os.unlink(file_path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Error deleting {file_path}: {e}")
+        return False
+    return True
+
+# reason not to apply a group, None if all its files still have the
+# (size, mtime_ns) stored when they were hashed; files to delete that are
+# already gone are fine
+def check_group(root: str, keep: str, delete: list, fingerprints: dict):
+    for path in [keep] + delete:
+        stored = fingerprints.get(path)
+        if stored is None or None in stored:
+            return f"no stored fingerprint for {path} (run gen_hashes.py --incremental)"
+        try:
+            st = os.stat(os.path.join(root, path))
+        except FileNotFoundError:
+            if path == keep:
+                return f"kept file {keep} does not exist"
+            continue
+        except OSError as e:
+            return f"cannot check {path}: {e}"
+        if (st.st_size, st.st_mtime_ns) != stored:
+            return f"{path} changed since it was hashed"
+    return None
+
+# delete the files of a plan and their rows, returns (deleted, failed);
+# groups with a changed file or without the kept file are skipped
+def apply_plan(db: CPigDb, plan, root: str, threads: int = DEFAULT_THREADS, b_verbose=False):
+    groups = list(plan)
+    fingerprints = db.get_path_fingerprints(
+        path for _, keep, delete in groups for path in [keep] + delete)
+
+    # imported here, plans are mostly only written
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        reasons = pool.map(lambda group: check_group(root, group[1], group[2], fingerprints), groups)
+        to_delete = []
+        for (md5, keep, delete), reason in zip(groups, reasons):
+            if reason is not None:
+                print(f"Skipping {md5}: {reason}")
+                continue
+            to_delete.extend(delete)
+        results = pool.map(unlink_file, (os.path.join(root, path) for path in to_delete))
+        deleted = [path for path, ok in zip(to_delete, results) if ok]
+
+    if b_verbose:
+        for path in deleted:
+            print(f"Deleted: {path}")
+    db.delete_entries(deleted)
+    return len(deleted), len(to_delete) - len(deleted)
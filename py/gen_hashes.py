@@ -1,14 +1,21 @@
 #!/usr/bin/python3
 
 import argparse
-import subprocess
-import hashlib
+import functools
+import io
+import mmap
 import os
+import time
+from collections import Counter, deque
+import contextlib
+from contextlib import contextmanager
 from pathlib import Path
-import shutil
-from PIL import Image
-import imagehash
+from CHashIndex import CHashIndex
+from CIoScheduler import CIoScheduler
+from pipeline import DEFAULT_QUEUE_SIZE, threaded
 from CPigDb import CPigDb
+from content_hash import HASH_ALGORITHMS, hash_bytes, new_hash
+from config import Config
 
 # main function
 def main():
@@ -19,75 +26,640 @@ def main():
         print(f"Error: '{target_dir}' is not a valid directory.")
         exit(1)
 
-    gen_hashes(target_dir)
+    config = Config(args.config)
+    extensions = None
+    if args.images_only:
+        extensions = config.get_image_extensions()
+    decode_scale = args.decode_scale or config.get_phash_decode_scale()
+    algorithm = args.hash_algorithm or config.get_hash_algorithm()
+    if algorithm not in HASH_ALGORITHMS:
+        # e.g. xxh128 from the config without the xxhash package
+        print(f"Error: hash algorithm '{algorithm}' is not available "
+              f"(available: {', '.join(HASH_ALGORITHMS)}).")
+        exit(1)
+    profiler = None
+    if args.profile or args.profile_interval:
+        from CProfiler import CProfiler
+        profiler = CProfiler(interval=args.profile_interval)
+
+    if args.watch:
+        watch(target_dir, jobs=args.jobs, batch_size=args.batch_size, extensions=extensions,
+              decode_scale=decode_scale, algorithm=algorithm, debounce=args.debounce,
+              max_delay=args.max_delay, wal=args.wal)
+    elif args.fill_md5 or args.migrate_hash:
+        fill_md5(target_dir, jobs=args.jobs, profiler=profiler, algorithm=algorithm,
+                 b_migrate=args.migrate_hash, wal=args.wal)
+    elif args.fast_doubles:
+        gen_hashes_fast(target_dir, jobs=args.jobs, batch_size=args.batch_size,
+                        extensions=extensions, profiler=profiler, algorithm=algorithm,
+                        io_order=args.io_order, wal=args.wal)
+    else:
+        gen_hashes(target_dir, jobs=args.jobs, incremental=args.incremental,
+                   batch_size=args.batch_size, extensions=extensions,
+                   decode_scale=decode_scale, profiler=profiler, algorithm=algorithm,
+                   io_order=args.io_order, readers=args.readers, queue_size=args.queue_size,
+                   wal=args.wal)
+
+    if args.export_index:
+        export_index(index_file=args.export_index, algorithm=algorithm)
+
+    if args.profile:
+        profiler.write_json(args.profile)
 
 # Arguments
 def parse_args():
     parser = argparse.ArgumentParser(
-        description="Generates MD5 hashes for all files in a directory tree using md5sum."
+        description="Generates MD5 and perceptual hashes for all files in a directory tree."
     )
     parser.add_argument(
         "directory",
         type=str,
         help="Target directory to scan"
     )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes for hashing (0 = one per CPU, default: 1)"
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "-i", "--incremental",
+        action="store_true",
+        help="Only hash new or changed files (size/mtime/inode/device) and mark vanished ones"
+    )
+    mode.add_argument(
+        "--fast-doubles",
+        action="store_true",
+        help="Fast exact duplicate scan: group by size, hash head/tail, full md5 only on collisions"
+    )
+    mode.add_argument(
+        "--fill-md5",
+        action="store_true",
+        help="Compute the full md5 for entries stored by --fast-doubles without one"
+    )
+    mode.add_argument(
+        "-w", "--watch",
+        action="store_true",
+        help="Keep the database current from filesystem events (Linux inotify) until interrupted"
+    )
+    mode.add_argument(
+        "--migrate-hash",
+        action="store_true",
+        help="Rehash all entries whose content hash uses another algorithm than the selected one"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=CPigDb.DEFAULT_BATCH_SIZE,
+        help=f"Rows per database transaction (default: {CPigDb.DEFAULT_BATCH_SIZE})"
+    )
+    parser.add_argument(
+        "--wal",
+        action="store_true",
+        help="Write with the SQLite WAL journal (fewer fsyncs; local file systems only, "
+             "readers then need write access to the database directory)"
+    )
+    parser.add_argument(
+        "--images-only",
+        action="store_true",
+        help="Only hash files with one of the configured image extensions"
+    )
+    parser.add_argument(
+        "--config",
+        type=str,
+        default=None,
+        help="Path to configuration file (image extensions, phash decode scale)"
+    )
+    parser.add_argument(
+        "--decode-scale",
+        type=int,
+        choices=Config.VAL_PHASH_DECODE_SCALES,
+        default=None,
+        help="Decode JPEGs at 1/N resolution for the perceptual hash (default: from config)"
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=2.0,
+        help="--watch: apply changes after this many seconds without events (default: 2)"
+    )
+    parser.add_argument(
+        "--max-delay",
+        type=float,
+        default=30.0,
+        help="--watch: apply changes at the latest after this many seconds (default: 30)"
+    )
+    parser.add_argument(
+        "--hash-algorithm",
+        type=str,
+        choices=list(HASH_ALGORITHMS),
+        default=None,
+        help="Content hash for exact duplicates (default: from config, md5)"
+    )
+    parser.add_argument(
+        "--io-order",
+        type=str,
+        choices=CIoScheduler.ORDERS,
+        default="walk",
+        help="Read files in walk order, by inode or by physical offset (FIEMAP); "
+             "sorting needs the complete walk first (default: walk)"
+    )
+    parser.add_argument(
+        "--readers",
+        type=readers_arg,
+        default=None,
+        help="Read files ahead with N concurrent reads, or 'auto' to adapt "
+             "the number to the measured throughput (default: workers read)"
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=DEFAULT_QUEUE_SIZE,
+        help="Files each stage (walk, read, hash) may work ahead of the next one; "
+             f"0 runs all stages one after another (default: {DEFAULT_QUEUE_SIZE})"
+    )
+    parser.add_argument(
+        "--export-index",
+        type=str,
+        nargs="?",
+        const="hashes.idx",
+        default=None,
+        help="Write the memory-mapped binary hash index afterwards (default: hashes.idx)"
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        nargs="?",
+        const="profile.json",
+        default=None,
+        help="Write per-stage times, throughput and slowest files as JSON (default: profile.json)"
+    )
+    parser.add_argument(
+        "--profile-interval",
+        type=float,
+        default=0.0,
+        help="Print profile stats every N seconds while running"
+    )
     return parser.parse_args()
 
+# --readers: a positive number or 'auto' (0 = adaptive)
+def readers_arg(value):
+    if value == "auto":
+        return 0
+    try:
+        readers = int(value)
+    except ValueError:
+        readers = 0
+    if readers < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive number or 'auto', got {value!r}")
+    return readers
+
 # gen_hash_function
-def gen_hashes(target_dir, hash_file="hashes.db"):
-    db = CPigDb(hash_file)
+# walk, read (with readers), hash and database write run as concurrent
+# stages connected by queues of queue_size entries (see pipeline.py);
+# this thread is the writer, the connection stays in it
+def gen_hashes(target_dir, hash_file="hashes.db", jobs=1, incremental=False,
+               batch_size=CPigDb.DEFAULT_BATCH_SIZE, extensions=None, decode_scale=1,
+               profiler=None, algorithm=CPigDb.DEFAULT_HASH_ALGORITHM, io_order="walk",
+               readers=None, queue_size=DEFAULT_QUEUE_SIZE, wal=False):
+    db = CPigDb(hash_file, wal=wal)
+    # opens the writer connection and creates the table if it does not exist
+    db.create_database()
+    db.profiler = profiler
  
-    print(f"Generating MD5 hashes for: {target_dir}")
-    all_files = get_all_files(target_dir)
-    total = len(all_files)
-    count = 0
+    print(f"Generating {algorithm} hashes for: {target_dir}")
+    # estimated total for the progress output until the walk is complete
+    progress = {"found": 0, "walk_done": False, "skipped": 0,
+                "estimate": db.count_images()}
+    # the database files may lie in the tree, they are never hashed
+    from reconcile import db_file_names
+    db_files = db_file_names(hash_file, target_dir)
+    entries = walk_files(target_dir, extensions, progress, skip=db_files)
+    if profiler is not None:
+        entries = profiler.timed_iter("walk", entries)
 
-    if shutil.which("md5sum"):
-        compute_md5 = compute_md5_md5sum
+    if incremental:
+        # rows of the database files hashed by older versions are dropped,
+        # not reported as vanished
+        db.delete_entries(db_files)
+        known = db.get_fingerprints()
+        seen = set()
+        entries = iter_changed(target_dir, entries, known, seen, progress)
+        store = db.upsert_images
     else:
-        compute_md5 = compute_md5_python
+        store = db.insert_images
 
-    for file_path in all_files:
-        md5_hash = compute_md5(file_path)       
-        #check if image
-        try:
-            image_hash = imagehash.phash(Image.open(file_path))    
-        except:
-            image_hash = None
-            
+    if io_order != "walk":
+        entries = CIoScheduler.order(entries, io_order)
+    entries = threaded(entries, queue_size, "walk")
+    scheduler = None
+    if readers is not None:
+        # readers == 0: adaptive
+        scheduler = CIoScheduler(readers or None, profiler=profiler)
+        entries = threaded(scheduler.iter_read(entries), queue_size, "read")
+
+    # the main process is the only writer, workers only hash; the pool
+    # takes entries from a bounded window instead of draining the queue
+    window = None
+    if scheduler is not None or queue_size > 0:
+        window = 4 * (jobs or os.cpu_count() or 1)
+    worker = functools.partial(hash_file_entry, decode_scale=decode_scale,
+                               profile=profiler is not None, algorithm=algorithm)
+    done = scheduler.release if scheduler is not None else None
+    rows = iter_rows(target_dir, entries, worker, progress, jobs, profiler, algorithm, window,
+                     done)
+    count = store(threaded(rows, queue_size, "hash"), batch_size=batch_size)
+    if scheduler is not None:
+        print(f"\n{scheduler.summary()}", end='')
+
+    if incremental:
+        vanished = [path for path, entry in known.items() if path not in seen and not entry[4]]
+        db.mark_missing(vanished)
+        print(f"\nIncremental: {count} new/changed, "
+              f"{progress['skipped']} unchanged, {len(vanished)} vanished", end='')
+    db.close()
+
+    print(f"\nHashes saved to: {hash_file}")
+
+# fast exact duplicate scan in stages, without perceptual hashes:
+# 1. only files with the same size can be identical
+# 2. md5 of head and tail (PARTIAL_HASH_SIZE each) for size collisions
+# 3. full md5 only where size and partial hash still collide
+# every row keeps the last stage reached (no hash, partial_hash or md5)
+def gen_hashes_fast(target_dir, hash_file="hashes.db", jobs=1,
+                    batch_size=CPigDb.DEFAULT_BATCH_SIZE, extensions=None, profiler=None,
+                    algorithm=CPigDb.DEFAULT_HASH_ALGORITHM, io_order="walk", wal=False):
+    db = CPigDb(hash_file, wal=wal)
+    db.create_database()
+    db.profiler = profiler
+    timed = profiler.timed_iter if profiler is not None else lambda name, it: it
+
+    print(f"Scanning for exact duplicates in: {target_dir}")
+    from reconcile import db_file_names
+    entries = list(timed("walk", walk_files(target_dir, extensions,
+                                            skip=db_file_names(hash_file, target_dir))))
+    size_count = Counter(fingerprint[0] for _, fingerprint in entries)
+    candidates = CIoScheduler.order(
+        (entry for entry in entries if size_count[entry[1][0]] > 1), io_order)
+    print(f"Stage 1: {len(entries)} files, {len(candidates)} with the same size")
+
+    partial = {}
+    full = {}
+    for file_path, fingerprint, partial_hash, md5_hash in \
+            timed("partial_hash", iter_hashes(candidates, functools.partial(
+                partial_hash_entry, algorithm=algorithm), jobs)):
+        partial[file_path] = partial_hash
+        # small files are read completely, so their md5 is already known
+        if md5_hash is not None:
+            full[file_path] = md5_hash
+
+    partial_count = Counter((entry[1][0], partial[entry[0]]) for entry in candidates)
+    remaining = [entry for entry in candidates
+                 if entry[0] not in full and partial_count[(entry[1][0], partial[entry[0]])] > 1]
+    print(f"Stage 2: {len(partial)} partial hashes, {len(remaining)} files need a full md5")
+
+    for file_path, md5_hash in timed("md5", iter_hashes(remaining, functools.partial(
+            md5_file_entry, algorithm=algorithm), jobs)):
+        full[file_path] = md5_hash
+    print(f"Stage 3: {len(full)} full md5 hashes")
+
+    rows = ((full.get(file_path), None, str(file_path.relative_to(target_dir)),
+             fingerprint, partial.get(file_path), algorithm)
+            for file_path, fingerprint in entries)
+    db.insert_images(rows, batch_size=batch_size)
+    db.close()
+
+    print(f"Hashes saved to: {hash_file}")
+
+# full md5 for the rows the fast duplicate scan left without one; with
+# b_migrate also for the rows hashed with another algorithm
+def fill_md5(target_dir, hash_file="hashes.db", jobs=1, profiler=None,
+             algorithm=CPigDb.DEFAULT_HASH_ALGORITHM, b_migrate=False, wal=False):
+    db = CPigDb(hash_file, wal=wal)
+    db.create_database()
+    timed = profiler.timed_iter if profiler is not None else lambda name, it: it
+
+    paths = db.get_paths_without_md5(algorithm if b_migrate else None)
+    entries = ((Path(target_dir) / path, None) for path in paths)
+    worker = functools.partial(md5_file_entry, algorithm=algorithm)
+    count = 0
+    for file_path, md5_hash in timed("md5", iter_hashes(entries, worker, jobs)):
+        if md5_hash is None:
+            continue
+        with profiler.timed("db_write", files=1) if profiler else contextlib.nullcontext():
+            db.update_hashes(str(file_path.relative_to(target_dir)), md5_hash=md5_hash,
+                             algorithm=algorithm)
+        count += 1
+        print(f"Progress: {count}", end='\r')
+    db.close()
+
+    print(f"\n{count} {algorithm} hashes added to: {hash_file}")
+
+# keep the database current from inotify events instead of rescans: only
+# created, written, moved and deleted files are processed, moves become
+# path updates; runs until interrupted
+def watch(target_dir, hash_file="hashes.db", jobs=1, batch_size=CPigDb.DEFAULT_BATCH_SIZE,
+          extensions=None, decode_scale=1, algorithm=CPigDb.DEFAULT_HASH_ALGORITHM,
+          debounce=2.0, max_delay=30.0, wal=False):
+    from CTreeWatcher import CTreeWatcher
+    from reconcile import db_file_names
+
+    db = CPigDb(hash_file, wal=wal)
+    db.create_database()
+    worker = functools.partial(hash_file_entry, decode_scale=decode_scale, algorithm=algorithm)
+
+    def hash_rows(entries):
+        progress = {"found": len(entries), "walk_done": True, "skipped": 0, "estimate": 0}
+        return iter_rows(target_dir, entries, worker, progress, jobs, algorithm=algorithm)
+
+    resync = functools.partial(gen_hashes, target_dir, hash_file, jobs, True, batch_size,
+                               extensions, decode_scale, algorithm=algorithm, wal=wal)
+    watcher = CTreeWatcher(target_dir, db, hash_rows, extensions,
+                           skip=db_file_names(hash_file, target_dir), debounce=debounce,
+                           max_delay=max_delay, batch_size=batch_size, resync=resync)
+    count = watcher.add_tree()
+    print(f"Watching {count} directories under: {target_dir}")
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.flush()
+    finally:
+        watcher.close()
+        db.close()
+
+# compact binary index of the database for fast lookups (CHashIndex)
+def export_index(hash_file="hashes.db", index_file=None, algorithm=None):
+    index_file = index_file or CHashIndex.default_file_name(hash_file)
+    db = CPigDb(hash_file)
+    algorithm = algorithm or db.get_main_hash_algorithm()
+    others = sum(count for name, count in db.get_hash_algorithms().items() if name != algorithm)
+    md5_count, phash_count = db.export_index(index_file, algorithm)
+    db.close()
+    print(f"Index with {md5_count} {algorithm} and {phash_count} phash entries saved to: "
+          f"{index_file}")
+    if others:
+        print(f"Warning: {others} entries hashed with another algorithm are not in the index "
+              f"(see --migrate-hash).")
+
+# new or changed walk entries, compared with the stored fingerprints
+def iter_changed(target_dir, entries, known, seen, progress):
+    for entry in entries:
+        rel_path = str(entry[0].relative_to(target_dir))
+        seen.add(rel_path)
+        stored = known.get(rel_path)
+        # unchanged: same fingerprint and not marked as missing
+        if stored is None or stored[4] or stored[:4] != entry[1]:
+            yield entry
+        else:
+            progress["skipped"] += 1
+
+# database rows for the hashed files, with progress output
+def iter_rows(target_dir, entries, worker, progress, jobs=1, profiler=None,
+              algorithm=CPigDb.DEFAULT_HASH_ALGORITHM, window=None, done=None):
+    count = 0
+    for file_path, fingerprint, md5_hash, image_hash, timings in \
+            iter_hashes(entries, worker, jobs, window, done):
         rel_path = file_path.relative_to(target_dir)
-        db.insert_image(md5_hash, str(image_hash), str(rel_path))
+        if profiler is not None:
+            profiler.add_timings(timings, rel_path, fingerprint[0])
+        yield md5_hash, str(image_hash), str(rel_path), fingerprint, None, algorithm
         count += 1
-        percent = int((count / total) * 100)
-        print(f"Progress: {percent}% ({count}/{total})", end='\r')
+        print_progress(count, progress)
 
-    print(f"\nHashes saved to: {hash_file}")
+# progress against the files found so far or the estimated total
+def print_progress(count, progress):
+    done = count + progress["skipped"]
+    found = progress["found"]
+    if progress["walk_done"]:
+        total = f"{found}"
+    elif progress["estimate"] > found:
+        total = f"~{progress['estimate']}"
+    else:
+        total = f"{found}+"
+    percent = int(done / max(int(total.strip("~+")), 1) * 100)
+    print(f"Progress: {min(percent, 100)}% ({done}/{total})", end='\r')
+
+# hash results in input order, serial or from a process pool; with window
+# at most that many entries are taken from the input ahead of the results
+# (entries carrying file data read ahead); done(entry) is called as soon as
+# an entry is hashed, from the pool's result thread (CIoScheduler.release)
+def iter_hashes(entries, worker, jobs=1, window=None, done=None):
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    if jobs <= 1:
+        for entry in entries:
+            result = worker(entry)
+            if done is not None:
+                done(entry)
+            yield result
+        return
+
+    import multiprocessing
+    if done is not None and window is None:
+        window = 4 * jobs
+    if window is not None:
+        with multiprocessing.Pool(processes=jobs) as pool:
+            pending = deque()
+            for entry in entries:
+                finished = None if done is None else functools.partial(_call_done, done, entry)
+                pending.append(pool.apply_async(worker, (entry,), callback=finished,
+                                                error_callback=finished))
+                if len(pending) >= window:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        return
+
+    # imap keeps the input order, so the database rows come out exactly
+    # like in a serial run; chunks amortize the IPC per file
+    with multiprocessing.Pool(processes=jobs) as pool:
+        yield from pool.imap(worker, entries, chunksize=16)
+
+# apply_async callback: the result is not needed, only the entry
+def _call_done(done, entry, _result):
+    done(entry)
+
+# read block size for streamed hashing
+READ_BLOCK_SIZE = 1024 * 1024
+# files from this size on are mapped instead of copied into the read buffer
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+# per process read buffer, grown on demand and reused for every file
+_read_buffer = bytearray()
 
-# md5 checksum with extern tool
-def compute_md5_md5sum(file_path):
+# md5 and perceptual hash of one (file_path, fingerprint) walk entry
+# (runs in the worker processes); with profile the seconds per stage are
+# returned as dict, else None. Entries from CIoScheduler.iter_read() carry
+# the file data as third item, the file is then only read if that is None
+def hash_file_entry(entry, decode_scale=1, profile=False, algorithm=CPigDb.DEFAULT_HASH_ALGORITHM):
+    file_path, fingerprint = entry[:2]
+    data = entry[2] if len(entry) > 2 else None
+    timings = {} if profile else None
     try:
-        result = subprocess.run(
-            ["md5sum", str(file_path)],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        return result.stdout.split()[0]
-    except subprocess.CalledProcessError as e:
+        start = time.perf_counter()
+        with open_file_data(file_path) if data is None else contextlib.nullcontext(data) as data:
+            start = lap(timings, "read", start)
+            md5_hash = hash_bytes(data, algorithm)
+            lap(timings, "md5", start)
+            image_hash = compute_phash(data, decode_scale, timings)
+    except OSError as e:
         print(f"Error hashing {file_path}: {e}")
+        return file_path, fingerprint, None, None, timings
+    return file_path, fingerprint, md5_hash, image_hash, timings
+
+# add the time since start to a stage of timings (if given), returns now
+def lap(timings, name, start):
+    now = time.perf_counter()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + now - start
+    return now
+
+# bytes read from the head and from the tail for the partial hash
+PARTIAL_HASH_SIZE = 16 * 1024
+
+# md5 of head and tail of one walk entry; files up to two blocks are read
+# completely, their partial hash is then also the full md5
+# returns (file_path, fingerprint, partial_hash, md5_hash or None)
+def partial_hash_entry(entry, algorithm=CPigDb.DEFAULT_HASH_ALGORITHM):
+    file_path, fingerprint = entry
+    hash_md5 = new_hash(algorithm)
+    try:
+        with open(file_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            hash_md5.update(f.read(PARTIAL_HASH_SIZE))
+            if size > 2 * PARTIAL_HASH_SIZE:
+                f.seek(-PARTIAL_HASH_SIZE, os.SEEK_END)
+                hash_md5.update(f.read(PARTIAL_HASH_SIZE))
+                return file_path, fingerprint, hash_md5.hexdigest(), None
+            hash_md5.update(f.read())
+    except OSError as e:
+        print(f"Error hashing {file_path}: {e}")
+        return file_path, fingerprint, None, None
+    return file_path, fingerprint, hash_md5.hexdigest(), hash_md5.hexdigest()
+
+# full md5 of one walk entry, returns (file_path, md5_hash)
+def md5_file_entry(entry, algorithm=CPigDb.DEFAULT_HASH_ALGORITHM):
+    file_path = entry[0]
+    try:
+        return file_path, compute_md5_python(file_path, algorithm)
+    except OSError as e:
+        print(f"Error hashing {file_path}: {e}")
+        return file_path, None
+
+# perceptual hash of in-memory file content, None if it is no image;
+# with decode_scale > 1 JPEGs are decoded at 1/decode_scale resolution in
+# grayscale (Image.draft), the hash only needs 32x32 pixels anyway.
+# PIL and imagehash (numpy, scipy, pywavelets) are imported on the first
+# call, runs without perceptual hashes never load them
+def compute_phash(data, decode_scale=1, timings=None):
+    from PIL import Image
+    import imagehash
+
+    start = time.perf_counter()
+    try:
+        stream = data if isinstance(data, mmap.mmap) else io.BytesIO(data)
+        stream.seek(0)
+        image = Image.open(stream)
+        if decode_scale > 1:
+            image.draft("L", (max(1, image.width // decode_scale),
+                              max(1, image.height // decode_scale)))
+        image.load()
+        start = lap(timings, "decode", start)
+        image_hash = imagehash.phash(image)
+        lap(timings, "phash", start)
+        return image_hash
+    except Exception:
+        lap(timings, "decode", start)
         return None
 
-# md5 checksum with python    
-def compute_md5_python(file_path):
-    hash_md5 = hashlib.md5()
+# file content read once: a view on the reusable buffer or an mmap
+@contextmanager
+def open_file_data(file_path):
+    global _read_buffer
+    with open(file_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data
+            return
+
+        if len(_read_buffer) < size:
+            _read_buffer = bytearray(size)
+        view = memoryview(_read_buffer)
+        try:
+            length = 0
+            while length < size:
+                n = f.readinto(view[length:size])
+                if not n:
+                    break
+                length += n
+            data = view[:length]
+            try:
+                yield data
+            finally:
+                data.release()
+        finally:
+            view.release()
+
+# md5 (or another content hash) with python, streamed in large blocks
+def compute_md5_python(file_path, algorithm=CPigDb.DEFAULT_HASH_ALGORITHM):
+    hash_md5 = new_hash(algorithm)
     with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        for chunk in iter(lambda: f.read(READ_BLOCK_SIZE), b""):
             hash_md5.update(chunk)
     return hash_md5.hexdigest()
 
+# size, mtime_ns, inode and device of a file (path or os.DirEntry)
+def get_fingerprint(file_path):
+    st = file_path.stat() if isinstance(file_path, os.DirEntry) else os.stat(file_path)
+    return (st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev)
+
+# streaming tree walk with os.scandir, yields (Path, fingerprint) per file;
+# the dirent type avoids a stat for directories, extensions are filtered
+# before any stat, progress["found"] counts the files found so far; skip
+# holds paths relative to target_dir that are left out (database files)
+def walk_files(target_dir, extensions=None, progress=None, skip=()):
+    if extensions is not None:
+        extensions = {ext.lower() for ext in extensions}
+    skip = {os.path.join(str(target_dir), name) for name in skip}
+    stack = [str(target_dir)]
+    while stack:
+        directory = stack.pop()
+        try:
+            it = os.scandir(directory)
+        except OSError as e:
+            print(f"Error reading {directory}: {e}")
+            continue
+        subdirs = []
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                        continue
+                    if not entry.is_file():
+                        continue
+                    if extensions is not None and \
+                            os.path.splitext(entry.name)[1].lower() not in extensions:
+                        continue
+                    if entry.path in skip:
+                        continue
+                    fingerprint = get_fingerprint(entry)
+                except OSError as e:
+                    print(f"Error reading {entry.path}: {e}")
+                    continue
+                if progress is not None:
+                    progress["found"] += 1
+                yield Path(entry.path), fingerprint
+        # depth first in directory order, like rglob
+        stack.extend(reversed(subdirs))
+    if progress is not None:
+        progress["walk_done"] = True
+
 # helper all files in tree
-def get_all_files(target_dir):
-    return [f for f in Path(target_dir).rglob('*') if f.is_file()]
+def get_all_files(target_dir, extensions=None):
+    return [file_path for file_path, _ in walk_files(target_dir, extensions)]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+
+##############################################################################
+# Checks incoming files against the archive with the binary hash index
+# (gen_hashes.py --export-index) instead of the database: the md5 of every
+# candidate is looked up by binary search in the memory-mapped index.
+##############################################################################
+
+import argparse
+import functools
+import time
+from pathlib import Path
+
+from CHashIndex import CHashIndex
+from content_hash import HASH_ALGORITHMS
+from gen_hashes import iter_hashes, md5_file_entry, walk_files
+
+# main function
+def main():
+    args = parse_args()
+    start = time.perf_counter()
+    with CHashIndex(args.index) as index:
+        if args.hash_algorithm and args.hash_algorithm != index.algorithm:
+            print(f"Error: {args.index} was hashed with {index.algorithm}, not {args.hash_algorithm}.")
+            exit(1)
+        if index.algorithm not in HASH_ALGORITHMS:
+            print(f"Error: hash algorithm '{index.algorithm}' of {args.index} is not available "
+                  f"(available: {', '.join(HASH_ALGORITHMS)}).")
+            exit(1)
+        known = new = 0
+        worker = functools.partial(md5_file_entry, algorithm=index.algorithm)
+        for file_path, md5_hash in iter_hashes(iter_candidates(args.paths), worker, args.jobs):
+            if md5_hash is None:
+                continue
+            paths = index.lookup_md5(md5_hash)
+            if paths:
+                known += 1
+                if not args.new_only:
+                    print(f"known: {file_path} -> {', '.join(paths)}")
+            else:
+                new += 1
+                print(f"new: {file_path}")
+    print(f"{known} known, {new} new files ({time.perf_counter() - start:.3f}s)")
+
+# Arguments
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Checks whether files are already in the archive, using the binary hash index."
+    )
+    parser.add_argument("index", type=str, help="Index file written by gen_hashes.py --export-index")
+    parser.add_argument("paths", type=str, nargs="+", help="Files or directories to check")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of worker processes for hashing (0 = one per CPU, default: 1)")
+    parser.add_argument("--hash-algorithm", choices=list(HASH_ALGORITHMS), default=None,
+                        help="Content hash the archive was hashed with, checked against the "
+                             "index (default: the one stored in the index)")
+    parser.add_argument("-n", "--new-only", action="store_true", help="Only print files not in the archive")
+    return parser.parse_args()
+
+# walk entries of all candidate files and directories
+def iter_candidates(paths):
+    for path in map(Path, paths):
+        if path.is_dir():
+            yield from walk_files(path)
+        else:
+            yield path, None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+
+##############################################################################
+# Local duplicate lookup daemon.
+#
+# "serve" loads the md5 and pHash index of a hash database once
+# (CLookupIndex) and answers batch queries over HTTP on localhost:
+#   GET  /status   index sizes, counters, hash algorithms of the database
+#                  and the last refresh error (null if the last one worked)
+#   POST /lookup   {"md5": [...], "phash": [...], "max_distance": n}
+#                  -> {"md5": {md5: [paths]}, "phash": {phash: [[distance, phash, [paths]]]}}
+#   POST /reload   rebuild the index from the database
+# A background thread polls the database, so rows written by a running
+# gen_hashes show up within the poll interval (with gen_hashes --wal the
+# polls never block the writer). "query" hashes files with the content hash
+# of the database (from /status) and asks a running daemon about them.
+##############################################################################
+
+import argparse
+import functools
+import json
+import sqlite3
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from CLookupIndex import CLookupIndex
+from CPigDb import CPigDb
+from content_hash import HASH_ALGORITHMS
+
+DEFAULT_PORT = 8765
+DEFAULT_POLL_INTERVAL = 0.5
+DEFAULT_RELOAD_INTERVAL = 3600.0
+
+# main function
+def main():
+    args = parse_args()
+    if args.command == "serve":
+        serve(args.db_path, args.port, args.poll_interval, args.reload_interval)
+    elif args.command == "query":
+        query_files(f"http://127.0.0.1:{args.port}", args.files, args.max_distance, args.jobs,
+                    args.hash_algorithm)
+
+# Arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="Local duplicate lookup daemon.")
+    parser.add_argument("-p", "--port", type=int, default=DEFAULT_PORT,
+                        help=f"Port on 127.0.0.1 (default: {DEFAULT_PORT})")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_args = commands.add_parser("serve", help="Load the index and answer queries")
+    serve_args.add_argument("db_path", type=str, help="Path to the database file")
+    serve_args.add_argument("--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL,
+                            help=f"Seconds between database change checks (default: {DEFAULT_POLL_INTERVAL})")
+    serve_args.add_argument("--reload-interval", type=float, default=DEFAULT_RELOAD_INTERVAL,
+                            help=f"Seconds between full index rebuilds, 0 = never (default: {DEFAULT_RELOAD_INTERVAL:.0f})")
+
+    query_args = commands.add_parser("query", help="Look up files at a running daemon")
+    query_args.add_argument("files", type=str, nargs="+", help="Files to look up")
+    query_args.add_argument("--max-distance", type=int, default=CPigDb.DEFAULT_PHASH_DISTANCE,
+                            help=f"Max. pHash bit distance (default: {CPigDb.DEFAULT_PHASH_DISTANCE})")
+    query_args.add_argument("-j", "--jobs", type=int, default=1,
+                            help="Number of worker processes for hashing (0 = one per CPU, default: 1)")
+    query_args.add_argument("--hash-algorithm", choices=list(HASH_ALGORITHMS), default=None,
+                            help="Content hash the archive was hashed with "
+                                 "(default: the one of most entries of the daemon's database)")
+    return parser.parse_args()
+
+# keeps the index up to date, owns the database connection; a database
+# error is logged and kept for /status, the next poll tries again
+def refresh_loop(index, ready, reload_event, poll_interval, reload_interval):
+    if not index.open():
+        ready.set()
+        return
+    last_load = None
+    while True:
+        try:
+            if last_load is None or reload_event.is_set() or \
+                    (reload_interval and time.monotonic() - last_load >= reload_interval):
+                reload_event.clear()
+                index.load()
+                last_load = time.monotonic()
+            else:
+                index.refresh()
+            if index.last_error is not None:
+                print("Index refresh works again")
+            index.last_error = None
+        except sqlite3.Error as e:
+            if str(e) != index.last_error:
+                print(f"Index refresh failed: {e}")
+            index.last_error = str(e)
+        ready.set()
+        reload_event.wait(poll_interval)
+
+def serve(db_path, port=DEFAULT_PORT, poll_interval=DEFAULT_POLL_INTERVAL,
+          reload_interval=DEFAULT_RELOAD_INTERVAL):
+    index = CLookupIndex(db_path)
+    ready = threading.Event()
+    reload_event = threading.Event()
+    start = time.perf_counter()
+    threading.Thread(target=refresh_loop, daemon=True,
+                     args=(index, ready, reload_event, poll_interval, reload_interval)).start()
+    ready.wait()
+    if index.db is None or index.db.get_error() != CPigDb.ERROR_STAT_NONE:
+        exit(1)
+    status = index.status()
+    print(f"Index of {status['total_images']} images loaded in {time.perf_counter() - start:.2f}s")
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/status":
+                self.send_json(index.status())
+            else:
+                self.send_error(404)
+
+        def do_POST(self):
+            if self.path == "/reload":
+                reload_event.set()
+                self.send_json({"reload": True})
+                return
+            if self.path != "/lookup":
+                self.send_error(404)
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                result = {
+                    "md5": index.lookup_md5(request.get("md5", [])),
+                    "phash": index.lookup_phash(request.get("phash", []),
+                                                int(request.get("max_distance", CPigDb.DEFAULT_PHASH_DISTANCE))),
+                }
+            except (ValueError, TypeError, AttributeError) as e:
+                self.send_error(400, str(e))
+                return
+            self.send_json(result)
+
+        def send_json(self, data):
+            body = json.dumps(data).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    print(f"Listening on http://127.0.0.1:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+# index sizes and counters of a running daemon
+def get_status(url):
+    with urllib.request.urlopen(f"{url}/status") as response:
+        return json.load(response)
+
+# content hash to query with: the given one or the one of most database entries
+def query_algorithm(url, algorithm=None):
+    algorithms = get_status(url).get("hash_algorithms", {})
+    if len(algorithms) > 1:
+        print(f"Warning: the database mixes hash algorithms ({algorithms}), "
+              f"only entries of one are found (see gen_hashes.py --migrate-hash).")
+    if algorithm is None:
+        algorithm = max(algorithms, key=algorithms.get) if algorithms else CPigDb.DEFAULT_HASH_ALGORITHM
+    elif algorithms and algorithm not in algorithms:
+        print(f"Error: the database has no entries hashed with {algorithm} "
+              f"({', '.join(algorithms)}).")
+        exit(1)
+    if algorithm not in HASH_ALGORITHMS:
+        print(f"Error: hash algorithm '{algorithm}' of the database is not available "
+              f"(available: {', '.join(HASH_ALGORITHMS)}).")
+        exit(1)
+    return algorithm
+
+# one batch query at a running daemon
+def lookup(url, md5_hashes=(), image_hashes=(), max_distance=CPigDb.DEFAULT_PHASH_DISTANCE):
+    request = urllib.request.Request(
+        f"{url}/lookup",
+        data=json.dumps({"md5": list(md5_hashes), "phash": list(image_hashes),
+                         "max_distance": max_distance}).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)
+
+def query_files(url, files, max_distance=CPigDb.DEFAULT_PHASH_DISTANCE, jobs=1, algorithm=None):
+    from gen_hashes import hash_file_entry, iter_hashes
+
+    algorithm = query_algorithm(url, algorithm)
+    hashes = [(str(file_path), md5_hash, image_hash and str(image_hash))
+              for file_path, _, md5_hash, image_hash, _
+              in iter_hashes(((Path(name), None) for name in files),
+                             functools.partial(hash_file_entry, algorithm=algorithm), jobs)]
+    start = time.perf_counter()
+    result = lookup(url, [md5 for _, md5, _ in hashes if md5],
+                    [phash for _, _, phash in hashes if phash], max_distance)
+    seconds = time.perf_counter() - start
+    for file_path, md5_hash, image_hash in hashes:
+        if md5_hash in result["md5"]:
+            print(f"known: {file_path} -> {', '.join(result['md5'][md5_hash])}")
+        elif image_hash in result["phash"]:
+            similar = [path for _, _, paths in result["phash"][image_hash] for path in paths]
+            print(f"similar: {file_path} -> {', '.join(similar)}")
+        else:
+            print(f"new: {file_path}")
+    print(f"{len(hashes)} files looked up in {seconds * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+##############################################################################
+# Clustering of near-duplicate images over their 64 bit perceptual hashes.
+#
+# The distinct pHashes are packed into a uint64 NumPy array. The Hamming
+# distances of all pairs are computed block by block (XOR + popcount over a
+# chunk x chunk matrix, so memory stays bounded by the chunk size) and every
+# pair within the threshold is merged with union-find. The result are the
+# connected components: a chain of similar images ends up in one cluster,
+# even if its ends are further apart than the threshold.
+##############################################################################
+
+from typing import Dict, List
+
+import numpy as np
+
+# hashes per block side; one block is DEFAULT_CHUNK_SIZE^2 uint64 (32 MiB)
+DEFAULT_CHUNK_SIZE = 2048
+
+# bits set per byte value, fallback for NumPy < 2.0
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def popcount64(values: np.ndarray) -> np.ndarray:
+    '''number of set bits of every element of a uint64 array'''
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    bytes_view = values.reshape(values.shape + (1,)).view(np.uint8)
+    return _POPCOUNT_TABLE[bytes_view].sum(axis=-1, dtype=np.uint8)
+
+
+def _find(parent: np.ndarray, i: int) -> int:
+    root = i
+    while parent[root] != root:
+        root = parent[root]
+    while parent[i] != root:
+        parent[i], i = root, parent[i]
+    return root
+
+
+def cluster_hashes(values: np.ndarray, max_distance: int,
+                   chunk_size: int = DEFAULT_CHUNK_SIZE) -> np.ndarray:
+    """Union-find over all pairs within max_distance bits.
+
+    values is a uint64 array of distinct hashes; returns for every index the
+    index of its cluster root.
+    """
+    count = len(values)
+    parent = np.arange(count, dtype=np.int64)
+    for start in range(0, count, chunk_size):
+        block = values[start:start + chunk_size]
+        # only blocks on and above the diagonal, every pair once
+        for other_start in range(start, count, chunk_size):
+            other = values[other_start:other_start + chunk_size]
+            distances = popcount64(block[:, None] ^ other[None, :])
+            rows, cols = np.nonzero(distances <= max_distance)
+            for row, col in zip((rows + start).tolist(), (cols + other_start).tolist()):
+                if row >= col:
+                    continue
+                root_a = _find(parent, row)
+                root_b = _find(parent, col)
+                if root_a != root_b:
+                    parent[max(root_a, root_b)] = min(root_a, root_b)
+    return np.array([_find(parent, i) for i in range(count)], dtype=np.int64)
+
+
+def cluster_paths(hash_paths: Dict[int, List[str]], max_distance: int,
+                  chunk_size: int = DEFAULT_CHUNK_SIZE) -> List[tuple]:
+    """Clusters {phash: [paths]} into [(smallest phash, [paths])] with more than one path."""
+    values = np.array(sorted(hash_paths), dtype=np.uint64)
+    if not len(values):
+        return []
+    roots = cluster_hashes(values, max_distance, chunk_size)
+    clusters = {}
+    # values are sorted, so the root is the smallest hash of its cluster
+    for value, root in zip(values.tolist(), roots.tolist()):
+        clusters.setdefault(root, []).extend(hash_paths[value])
+    return [(int(values[root]), paths) for root, paths in sorted(clusters.items())
+            if len(paths) > 1]
@@ -0,0 +1,80 @@
+##############################################################################
+# Bounded producer/consumer stages for gen_hashes.
+#
+# threaded(iterable) runs the iteration of iterable in its own thread and
+# hands the items over through a bounded queue: the stage works ahead of
+# its consumer by at most queue_size items and then blocks (backpressure),
+# so memory stays bounded however fast walk or disk are (the file data of
+# the read stage is bounded in bytes by CIoScheduler). Chained, every
+# stage of walk -> read -> hash -> write runs concurrently:
+#
+#   entries = threaded(walk_files(...))             # walk thread
+#   entries = threaded(scheduler.iter_read(...))    # reader threads
+#   rows = threaded(iter_rows(...))                 # hashing (process pool)
+#   db.insert_images(rows)                          # caller is the writer
+#
+# An exception in a stage is raised in the consumer; when the consumer
+# stops early (error, KeyboardInterrupt) the stages stop at their next item.
+##############################################################################
+
+import queue
+import threading
+
+# items a stage may work ahead of its consumer
+DEFAULT_QUEUE_SIZE = 64
+
+# seconds a blocked stage waits before checking whether it was stopped
+_POLL_SECONDS = 0.1
+
+_ITEM = 0
+_DONE = 1
+_ERROR = 2
+
+
+def threaded(iterable, queue_size: int = DEFAULT_QUEUE_SIZE, name: str = None):
+    """Yields the items of iterable, produced in a background thread at
+    most queue_size items ahead; queue_size 0 iterates in the caller."""
+    if queue_size <= 0:
+        yield from iterable
+        return
+
+    items = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def put(kind, value) -> bool:
+        while not stop.is_set():
+            try:
+                items.put((kind, value), timeout=_POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put(_ITEM, item):
+                    return
+            put(_DONE, None)
+        except BaseException as e:
+            put(_ERROR, e)
+        finally:
+            # e.g. terminates the process pool of a hashing stage
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, value = items.get()
+            if kind == _DONE:
+                break
+            if kind == _ERROR:
+                raise value
+            yield value
+    finally:
+        stop.set()
+    thread.join()
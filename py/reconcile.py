@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+
+##############################################################################
+# Reconciliation of a hash database with the file tree it describes.
+#
+# The tree is walked recursively in the byte order of the relative paths
+# (the order of SQLite's ORDER BY path) and merge-joined with the sorted
+# stream of database paths, so one pass reports
+#   new      - file on disk without database entry
+#   missing  - database entry without file
+#   changed  - size or mtime differ from the stored fingerprint
+# Only one directory listing and a bounded window of pending stat calls
+# are held in memory at any time. The stat calls for the matched paths run
+# in a thread pool, which hides the latency of network file systems.
+##############################################################################
+
+import argparse
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from CPigDb import CPigDb
+
+EVENT_NEW = "new"
+EVENT_MISSING = "missing"
+EVENT_CHANGED = "changed"
+
+DEFAULT_THREADS = 16
+# pending stat calls per thread
+STAT_WINDOW_PER_THREAD = 64
+
+# main function
+def main():
+    args = parse_args()
+    db = CPigDb(args.db_path)
+    if db.get_error() != db.ERROR_STAT_NONE:
+        print(f"Error opening database: {db.get_error()}")
+        exit(1)
+    root = Path(args.root or os.path.dirname(os.path.abspath(args.db_path)))
+
+    counts = {EVENT_NEW: 0, EVENT_MISSING: 0, EVENT_CHANGED: 0}
+    for event, path in reconcile(db, root, threads=args.threads,
+                                 skip=db_file_names(args.db_path, root)):
+        counts[event] += 1
+        if args.verbose:
+            print(f"{event}: {path}")
+    for event, count in counts.items():
+        print(f"{event}: {count}")
+
+# Arguments
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Reports new, missing and changed files of a hash database in one pass."
+    )
+    parser.add_argument("db_path", type=str, help="Path to the database file")
+    parser.add_argument("root", type=str, nargs="?", default=None,
+                        help="Root directory of the stored paths (default: directory of the database)")
+    parser.add_argument("-t", "--threads", type=int, default=DEFAULT_THREADS,
+                        help=f"Threads for stat calls (default: {DEFAULT_THREADS})")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Print every file")
+    return parser.parse_args()
+
+# relative names of the database files below root (skipped by the walk)
+def db_file_names(db_path, root):
+    try:
+        name = os.path.relpath(os.path.abspath(db_path), os.path.abspath(root))
+    except ValueError:
+        return set()
+    return {name + suffix for suffix in ("", "-wal", "-shm", "-journal")}
+
+# recursive walk yielding the relative paths of all files in sorted order;
+# a directory "x" sorts like "x/", so every subtree lands at the position
+# of its paths among the siblings
+def walk_sorted(root, prefix=""):
+    try:
+        with os.scandir(os.path.join(root, prefix) if prefix else root) as it:
+            children = []
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        children.append((entry.name + "/", True))
+                    elif entry.is_file():
+                        children.append((entry.name, False))
+                except OSError:
+                    continue
+    except OSError as e:
+        print(f"Error reading {os.path.join(root, prefix)}: {e}")
+        return
+    children.sort()
+    for name, is_dir in children:
+        if is_dir:
+            yield from walk_sorted(root, prefix + name)
+        else:
+            yield prefix + name
+
+# stat of one relative path, None if it is gone
+def stat_file(root, rel_path):
+    try:
+        return os.stat(os.path.join(root, rel_path))
+    except OSError:
+        return None
+
+# merge-join of walk_sorted(root) and the sorted database paths,
+# yields (event, relative path)
+def reconcile(db, root, threads=DEFAULT_THREADS, skip=()):
+    root = str(root)
+    files = (path for path in walk_sorted(root) if path not in skip)
+    rows = db.iter_paths_sorted()
+    window = max(1, threads) * STAT_WINDOW_PER_THREAD
+    pending = deque()
+
+    def compare(future, rel_path, size, mtime_ns):
+        st = future.result()
+        if st is None:
+            return EVENT_MISSING, rel_path
+        if st.st_size != size or st.st_mtime_ns != mtime_ns:
+            return EVENT_CHANGED, rel_path
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        file_path = next(files, None)
+        row = next(rows, None)
+        while file_path is not None or row is not None:
+            if row is None or (file_path is not None and file_path < row[0]):
+                yield EVENT_NEW, file_path
+                file_path = next(files, None)
+                continue
+            rel_path, size, mtime_ns, missing = row
+            if file_path is None or rel_path < file_path:
+                if not missing:
+                    yield EVENT_MISSING, rel_path
+                row = next(rows, None)
+                continue
+            # on disk and in the database
+            if missing:
+                yield EVENT_CHANGED, rel_path
+            elif size is not None and mtime_ns is not None:
+                pending.append((pool.submit(stat_file, root, rel_path), rel_path, size, mtime_ns))
+                while len(pending) >= window:
+                    event = compare(*pending.popleft())
+                    if event is not None:
+                        yield event
+            file_path = next(files, None)
+            row = next(rows, None)
+
+        while pending:
+            event = compare(*pending.popleft())
+            if event is not None:
+                yield event
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+
+##############################################################################
+# Verification of the reduced-resolution JPEG decoding for the perceptual
+# hash (Config phash_decode_scale / gen_hashes --decode-scale).
+#
+# Hashes a random sample of images of a directory tree once with a full
+# decode and once with the reduced decode and reports how many hashes
+# differ, the bit distances and the time spent for both.
+##############################################################################
+
+import argparse
+import random
+import time
+from collections import Counter
+from pathlib import Path
+
+from config import Config
+from CPigDb import CPigDb
+from gen_hashes import walk_files, open_file_data, compute_phash
+
+# main function
+def main():
+    args = parse_args()
+    target_dir = Path(args.directory).resolve()
+
+    if not target_dir.is_dir():
+        print(f"Error: '{target_dir}' is not a valid directory.")
+        exit(1)
+
+    config = Config(args.config)
+    decode_scale = args.decode_scale or config.get_phash_decode_scale()
+    if decode_scale == 1:
+        decode_scale = 8
+    verify_decode(target_dir, decode_scale, args.sample, config.get_image_extensions(),
+                  args.seed)
+
+# Arguments
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compares perceptual hashes of full and reduced JPEG decoding on a sample."
+    )
+    parser.add_argument(
+        "directory",
+        type=str,
+        help="Directory tree to sample images from"
+    )
+    parser.add_argument(
+        "-n", "--sample",
+        type=int,
+        default=500,
+        help="Number of images to compare (default: 500)"
+    )
+    parser.add_argument(
+        "--decode-scale",
+        type=int,
+        choices=Config.VAL_PHASH_DECODE_SCALES[1:],
+        default=None,
+        help="Reduced decode scale to verify (default: from config, else 8)"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Random seed of the sample (default: 0)"
+    )
+    parser.add_argument(
+        "--config",
+        type=str,
+        default=None,
+        help="Path to configuration file"
+    )
+    return parser.parse_args()
+
+# random sample of the image files of a tree (reservoir sampling)
+def sample_files(target_dir, sample_size, extensions, seed=0):
+    rnd = random.Random(seed)
+    sample = []
+    for count, (file_path, _) in enumerate(walk_files(target_dir, extensions)):
+        if count < sample_size:
+            sample.append(file_path)
+        else:
+            index = rnd.randint(0, count)
+            if index < sample_size:
+                sample[index] = file_path
+    return sample
+
+# compare full and reduced decoding, returns the report as dict
+def verify_decode(target_dir, decode_scale, sample_size, extensions, seed=0):
+    files = sample_files(target_dir, sample_size, extensions, seed)
+    print(f"Comparing full and 1/{decode_scale} decoding for {len(files)} images")
+
+    distances = Counter()
+    time_full = 0.0
+    time_fast = 0.0
+    skipped = 0
+    for file_path in files:
+        with open_file_data(file_path) as data:
+            start = time.perf_counter()
+            full_hash = compute_phash(data)
+            time_full += time.perf_counter() - start
+            start = time.perf_counter()
+            fast_hash = compute_phash(data, decode_scale)
+            time_fast += time.perf_counter() - start
+        if full_hash is None or fast_hash is None:
+            skipped += 1
+            continue
+        distances[int(full_hash - fast_hash)] += 1
+
+    compared = sum(distances.values())
+    report = {
+        "decode_scale": decode_scale,
+        "compared": compared,
+        "skipped": skipped,
+        "identical": distances[0],
+        "different": compared - distances[0],
+        "within_similar_distance": sum(n for d, n in distances.items()
+                                       if d <= CPigDb.DEFAULT_PHASH_DISTANCE),
+        "max_distance": max(distances) if distances else 0,
+        "time_full_s": round(time_full, 3),
+        "time_fast_s": round(time_fast, 3),
+        "speedup": round(time_full / time_fast, 2) if time_fast else None,
+        "distances": dict(sorted(distances.items())),
+    }
+    for key, value in report.items():
+        print(f"{key}: {value}")
+    return report
+
+
+if __name__ == "__main__":
+    main()